@@ -8,7 +8,31 @@
 
 # Should be run in the CICE history output directory
 
-import os, glob, re, subprocess, calendar
+# By default the conversion uses nccopy and ncrcat. With --inprocess it is
+# done with the netCDF4 module instead, one variable of one day at a time,
+# without starting a process for each month.
+
+# With --jobs N, N months are converted at once. Each month's output is
+# printed in order once it is finished, and the first failure stops the
+# conversion. Files are written under temporary names and renamed when
+# complete, so a failure leaves no partial iceh_m or iceh_d files.
+
+# Months whose iceh_m and iceh_d files already exist are skipped if those
+# pass a quick check (see check_month), so a rerun only converts the months
+# missing or invalid. --force converts every month again.
+
+# The deflate level, shuffle and chunking are read from the JSON file given
+# by --config or $ICE_NC4_CONFIG (default ice_nc4.json next to this script),
+# if it exists. --benchmark YYYY-MM writes that file: it converts the month
+# with each combination of settings in BENCHMARK_GRID, times writing and
+# reading the daily file back, and saves the smallest settings (see
+# best_settings). The daily file is written the way the conversion will write
+# it, with ncrcat or, with --inprocess, the netCDF4 module. The shuffle
+# setting isn't passed to ncrcat, which uses its own default, so without
+# --inprocess it only applies to the monthly file and isn't benchmarked.
+
+import os, sys, glob, re, subprocess, calendar, argparse, concurrent.futures, itertools, traceback
+import json, tempfile, time
 
 # Expect that all files have prefix iceh
 
@@ -16,36 +40,53 @@ import os, glob, re, subprocess, calendar
 # Rename to iceh_m and iceh_d so that they don't match.
 
 verbose = True
-re_monthly = re.compile("iceh.\d\d\d\d-\d\d.nc")
-re_daily = re.compile("iceh.\d\d\d\d-\d\d-\d\d.nc")
-monthly = []
-for f in glob.glob('iceh.*.nc'):
-    m = re_monthly.match(f)
-    if m:
-        monthly.append(f)
-        continue
-    m = re_daily.match(f)
-    if m:
-        continue
-    raise Exception("Unexpected file %s" % f)
-
-if not monthly:
-    print("No files to process")
-
-monthly.sort()
-
-cal = calendar.Calendar()
-for f in monthly:
-    # Note that spaces are not allowed in subprocess arguments
-    cmd = ["nccopy", "-k3", "-d4", f, "iceh_m%s" % f[4:]]
-    if verbose:
-        print(cmd)
-    subprocess.check_call(cmd, stderr=subprocess.STDOUT)
+re_monthly = re.compile(r"iceh\.\d\d\d\d-\d\d\.nc$")
+re_daily = re.compile(r"iceh\.\d\d\d\d-\d\d-\d\d\.nc$")
 
-    year = int(f[5:9])
-    month = int(f[10:12])
+# Defaults, overridden by the config file. chunking is 'record' for one
+# record per chunk, or 'time' for all the records in a single chunk
+SETTINGS = {'deflate': 4, 'shuffle': False, 'chunking': 'record'}
+CONFIG_ENV = 'ICE_NC4_CONFIG'
+CONFIG_NAME = 'ice_nc4.json'
+
+BENCHMARK_GRID = {'deflate': [0, 1, 2, 4, 6, 9],
+                  'shuffle': [False, True],
+                  'chunking': ['record', 'time']}
+# Settings within this fraction of the smallest size are ranked by time
+SIZE_TOLERANCE = 0.02
+
+def config_file(filename=None):
+    return (filename or os.environ.get(CONFIG_ENV) or
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), CONFIG_NAME))
 
-    cmd = ["ncrcat", "-4", "--deflate", "4"]
+def load_settings(filename=None):
+    """SETTINGS updated from the config file, if there is one"""
+    settings = dict(SETTINGS)
+    try:
+        with open(config_file(filename)) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return settings
+    settings.update((k, config[k]) for k in SETTINGS if k in config)
+    return settings
+
+def find_monthly():
+    monthly = []
+    for f in glob.glob('iceh.*.nc'):
+        m = re_monthly.match(f)
+        if m:
+            monthly.append(f)
+            continue
+        m = re_daily.match(f)
+        if m:
+            continue
+        print("Skipping unexpected file %s" % f)
+    monthly.sort()
+    return monthly
+
+def daily_files(year, month, log=print):
+    cal = calendar.Calendar()
+    files = []
     for date in cal.itermonthdates(year,month):
         # Days of this month (assuming proleptic Gregorian)
         # This returns days of preceding and following months
@@ -55,14 +96,363 @@ for f in monthly:
             # check if the file exists before appending to our list
             if os.path.exists("iceh.%4.4d-%2.2d-%2.2d.nc" %
                                 (date.year, date.month, date.day)):
-                cmd.append("iceh.%4.4d-%2.2d-%2.2d.nc" %
-                           (date.year, date.month, date.day))
+                files.append("iceh.%4.4d-%2.2d-%2.2d.nc" %
+                             (date.year, date.month, date.day))
+            else:
+                log("iceh.%4.4d-%2.2d-%2.2d.nc" %
+                    (date.year, date.month, date.day) +
+                    " does not exist, skip this file")
+    return files
+
+def concatenate(files, output, settings=SETTINGS):
+    """
+    Write the files joined along their unlimited dimension to a netCDF4
+    file, compressing and chunking all variables as set in settings.
+    Variables without the unlimited dimension come from the first file, as
+    do the attributes. The records are copied one variable of one file at a
+    time.
+    """
+    import netCDF4
+
+    with netCDF4.Dataset(files[0]) as first, \
+         netCDF4.Dataset(output, 'w', format='NETCDF4') as ds:
+        first.set_auto_maskandscale(False)
+        record_dim = None
+        for name, dim in first.dimensions.items():
+            if dim.isunlimited():
+                record_dim = name
+                ds.createDimension(name, None)
+            else:
+                ds.createDimension(name, len(dim))
+        ds.setncatts({a: first.getncattr(a) for a in first.ncattrs()})
+
+        times = []
+        for f in files:
+            with netCDF4.Dataset(f) as src:
+                src.set_auto_maskandscale(False)
+                if record_dim in src.variables:
+                    times.append(src.variables[record_dim][:])
+                elif record_dim:
+                    times.append(range(len(src.dimensions[record_dim])))
+        nrec = sum(len(t) for t in times)
+
+        record_vars = []
+        for name, var in first.variables.items():
+            attributes = {a: var.getncattr(a) for a in var.ncattrs()}
+            fill_value = attributes.pop('_FillValue', None)
+            chunksizes = None
+            if record_dim in var.dimensions:
+                chunk_records = nrec if settings['chunking'] == 'time' else 1
+                chunksizes = [chunk_records if d == record_dim else len(first.dimensions[d])
+                              for d in var.dimensions]
+            out = ds.createVariable(name, var.dtype, var.dimensions,
+                                    zlib=settings['deflate'] > 0,
+                                    complevel=settings['deflate'],
+                                    shuffle=settings['shuffle'],
+                                    chunksizes=chunksizes, fill_value=fill_value)
+            out.set_auto_maskandscale(False)
+            out.setncatts(attributes)
+            if record_dim in var.dimensions:
+                record_vars.append(name)
+            else:
+                out[...] = var[...]
+
+        # Extend the record dimension to its final length before writing
+        # the data
+        if record_dim in ds.variables:
+            ds.variables[record_dim][:] = [t for day in times for t in day]
+
+        start = 0
+        for f in files:
+            with netCDF4.Dataset(f) as src:
+                src.set_auto_maskandscale(False)
+                nrec = len(src.dimensions[record_dim]) if record_dim else 0
+                for name in record_vars:
+                    if name == record_dim:
+                        continue
+                    var = src.variables[name]
+                    index = tuple(slice(start, start+nrec) if d == record_dim
+                                  else slice(None) for d in var.dimensions)
+                    ds.variables[name][index] = var[...]
+            start += nrec
+
+def output_names(f):
+    return "iceh_m%s" % f[4:], "iceh_d%s" % f[4:]
+
+def record_summary(filename):
+    """Number of records and the variable names of a netCDF file"""
+    import netCDF4
+
+    with netCDF4.Dataset(filename) as ds:
+        nrec = 0
+        for dim in ds.dimensions.values():
+            if dim.isunlimited():
+                nrec = len(dim)
+        return nrec, sorted(ds.variables)
+
+def check_month(f):
+    """
+    Problems with the existing outputs for the monthly file f: each must
+    have the variables of its inputs, iceh_m the records of f and iceh_d one
+    record for each daily file of the month. Returns an empty list if they
+    are valid.
+    """
+    year = int(f[5:9])
+    month = int(f[10:12])
+    daily = daily_files(year, month, log=lambda line: None)
+    problems = []
+    for out, inputs in zip(output_names(f), ([f], daily)):
+        if not os.path.exists(out):
+            problems.append("%s does not exist" % out)
+            continue
+        try:
+            nrec, variables = record_summary(out)
+        except OSError as e:
+            problems.append("%s can't be read: %s" % (out, e))
+            continue
+        if not inputs:
+            continue
+        expected_nrec, expected_variables = record_summary(inputs[0])
+        expected_nrec *= len(inputs)
+        if nrec != expected_nrec:
+            problems.append("%s has %d records, expected %d" % (out, nrec, expected_nrec))
+        if variables != expected_variables:
+            problems.append("%s variables differ from %s" % (out, inputs[0]))
+    return problems
+
+def tmp_name(f):
+    # Hidden, so not matched by iceh_[dm]* in history_postprocess.sh
+    return ".tmp.%s" % f
+
+def run(cmd, log=print):
+    if verbose:
+        log(cmd)
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.stdout:
+        log(result.stdout.rstrip())
+    result.check_returncode()
+
+def ncrcat_command(daily, output, settings):
+    cmd = ["ncrcat", "-4", "--deflate", str(settings['deflate'])]
+    if daily:
+        nrec = record_summary(daily[0])[0] * len(daily) if settings['chunking'] == 'time' else 1
+        cmd.append("--cnk_dmn=time,%d" % nrec)
+    return cmd + daily + [output]
+
+def process_month(f, inprocess=False, log=print, settings=SETTINGS):
+    year = int(f[5:9])
+    month = int(f[10:12])
+    daily = daily_files(year, month, log)
+    monthly_out, daily_out = output_names(f)
+
+    try:
+        if inprocess:
+            if verbose:
+                log("concatenate %s %s" % ([f], monthly_out))
+            concatenate([f], tmp_name(monthly_out), settings)
+            if verbose:
+                log("concatenate %s %s" % (daily, daily_out))
+            concatenate(daily, tmp_name(daily_out), settings)
+        else:
+            # Note that spaces are not allowed in subprocess arguments
+            cmd = ["nccopy", "-k3", "-d%d" % settings['deflate']]
+            if settings['shuffle']:
+                cmd.append("-s")
+            # Set the chunking explicitly for 'record' too, as the default
+            # layout depends on the netCDF library version
+            nrec = record_summary(f)[0] if settings['chunking'] == 'time' else 1
+            cmd.append("-ctime/%d" % nrec)
+            run(cmd + [f, tmp_name(monthly_out)], log)
+            run(ncrcat_command(daily, tmp_name(daily_out), settings), log)
+        os.replace(tmp_name(monthly_out), monthly_out)
+        os.replace(tmp_name(daily_out), daily_out)
+    except BaseException:
+        for out in (monthly_out, daily_out):
+            if os.path.exists(tmp_name(out)):
+                os.remove(tmp_name(out))
+        raise
+
+def logged_month(f, inprocess=False, settings=SETTINGS):
+    """
+    process_month in a worker, returning its log and the error message, or
+    None if it succeeded
+    """
+    lines = []
+    try:
+        process_month(f, inprocess, lambda line: lines.append(str(line)), settings)
+    except Exception:
+        return lines, traceback.format_exc()
+    return lines, None
+
+def process_months(monthly, inprocess=False, jobs=1, settings=SETTINGS):
+    """
+    Convert the months with jobs processes, printing the log of each month
+    in order. After the first failure no more months are started; returns
+    False once those already running have finished.
+    """
+    results = {}
+    printed = 0
+    failed = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Only jobs months are submitted at a time, so none are queued when
+        # one fails
+        pending = {}
+        queue = iter(enumerate(monthly))
+        for i, f in itertools.islice(queue, jobs):
+            pending[executor.submit(logged_month, f, inprocess, settings)] = i
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                results[i] = future.result()
+                if results[i][1] is not None and failed is None:
+                    failed = i
+                if failed is None:
+                    for j, f in queue:
+                        pending[executor.submit(logged_month, f, inprocess, settings)] = j
+                        break
+            while printed in results and printed != failed:
+                print("\n".join(results[printed][0]))
+                printed += 1
+    if failed is None:
+        return True
+    # Logs of the other months that had started, then the failure
+    for i in sorted(results):
+        if i >= printed and i != failed:
+            print("\n".join(results[i][0]))
+    lines, error = results[failed]
+    print("\n".join(lines))
+    print("Error processing %s\n%s" % (monthly[failed], error))
+    return False
+
+def read_times(filename):
+    """
+    Seconds to read every record variable of filename a record at a time
+    (maps of a day) and as time series at a few points
+    """
+    import netCDF4
+
+    with netCDF4.Dataset(filename) as ds:
+        ds.set_auto_maskandscale(False)
+        record_vars = [v for v in ds.variables.values()
+                       if v.ndim > 1 and ds.dimensions[v.dimensions[0]].isunlimited()]
+        t0 = time.perf_counter()
+        for var in record_vars:
+            for i in range(var.shape[0]):
+                var[i]
+        t1 = time.perf_counter()
+        for var in record_vars:
+            for k in range(5):
+                point = tuple(n * (k + 1) // 6 for n in var.shape[1:])
+                var[(slice(None),) + point]
+        t2 = time.perf_counter()
+    return t1 - t0, t2 - t1
+
+def benchmark(f, inprocess=False):
+    """
+    Convert the daily files of the month of the monthly file f with each
+    combination of BENCHMARK_GRID, with ncrcat or, if inprocess, concatenate.
+    Returns a list of the settings with the size and write and read times of
+    the output. ncrcat ignores shuffle, so without inprocess it isn't varied
+    and is None in the results.
+    """
+    year = int(f[5:9])
+    month = int(f[10:12])
+    daily = daily_files(year, month)
+    grid = dict(BENCHMARK_GRID)
+    if not inprocess:
+        grid['shuffle'] = [None]
+    results = []
+    with tempfile.TemporaryDirectory(dir='.') as tmpdir:
+        output = os.path.join(tmpdir, 'iceh_d.nc')
+        keys = sorted(grid)
+        for values in itertools.product(*(grid[k] for k in keys)):
+            settings = dict(zip(keys, values))
+            t0 = time.perf_counter()
+            if inprocess:
+                concatenate(daily, output, settings)
             else:
-                print("iceh.%4.4d-%2.2d-%2.2d.nc" %
-                       (date.year, date.month, date.day) + 
-                       " does not exist, skip this file")
+                run(ncrcat_command(daily, output, settings), log=lambda line: None)
+            write = time.perf_counter() - t0
+            read_records, read_series = read_times(output)
+            results.append(dict(settings, size=os.path.getsize(output),
+                                write=write, read_records=read_records,
+                                read_series=read_series))
+            os.remove(output)
+    return results
+
+def best_settings(results):
+    """
+    The smallest settings, or the fastest to write and read of those within
+    SIZE_TOLERANCE of the smallest size
+    """
+    smallest = min(r['size'] for r in results)
+    candidates = [r for r in results if r['size'] <= smallest * (1 + SIZE_TOLERANCE)]
+    best = min(candidates, key=lambda r: r['write'] + r['read_records'] + r['read_series'])
+    return {k: best[k] for k in SETTINGS if best[k] is not None}
 
-    cmd.append("iceh_d%s" % f[4:])
+def main():
+    parser = argparse.ArgumentParser(description="Convert CICE history to netCDF4 and combine daily files into monthly files")
+    parser.add_argument('--inprocess', action='store_true',
+                        help="Convert with the netCDF4 module rather than nccopy and ncrcat")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of months to convert at once")
+    parser.add_argument('--force', action='store_true',
+                        help="Convert months even if they have valid outputs")
+    parser.add_argument('--config',
+                        help="Settings file (default $%s or %s next to this script)" % (CONFIG_ENV, CONFIG_NAME))
+    parser.add_argument('--benchmark', metavar='YYYY-MM',
+                        help="Benchmark the settings on this month and save the best to the settings file")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        results = benchmark("iceh.%s.nc" % args.benchmark, args.inprocess)
+        print("%7s %7s %8s %12s %8s %12s %11s" % ("deflate", "shuffle", "chunking", "size",
+              "write s", "read maps s", "read pts s"))
+        for r in results:
+            shuffle = 'ncrcat' if r['shuffle'] is None else r['shuffle']
+            print("%7d %7s %8s %12d %8.3f %12.3f %11.3f" % (r['deflate'], shuffle,
+                  r['chunking'], r['size'], r['write'], r['read_records'], r['read_series']))
+        # Without --inprocess the shuffle setting is kept from the settings file
+        settings = dict(load_settings(args.config), **best_settings(results))
+        config = dict(settings, benchmark={'month': args.benchmark, 'inprocess': args.inprocess,
+                                           'results': results})
+        with open(config_file(args.config), 'w') as f:
+            json.dump(config, f, indent=1)
+        print("Saved %s to %s" % (settings, config_file(args.config)))
+        return
+
+    settings = load_settings(args.config)
     if verbose:
-        print(cmd)
-    subprocess.check_call(cmd, stderr=subprocess.STDOUT)
+        print("Settings", settings)
+    if settings['shuffle'] and not args.inprocess:
+        print("Warning: shuffle is only applied to the iceh_m files, ncrcat uses its own default for iceh_d",
+              file=sys.stderr)
+
+    monthly = find_monthly()
+    if not monthly:
+        print("No files to process")
+
+    if not args.force:
+        todo = []
+        for f in monthly:
+            if not any(map(os.path.exists, output_names(f))):
+                todo.append(f)
+                continue
+            problems = check_month(f)
+            if problems:
+                print("Converting %s again: %s" % (f, "; ".join(problems)))
+                todo.append(f)
+            elif verbose:
+                print("Skipping %s, already converted" % f)
+        monthly = todo
+
+    if args.jobs == 1:
+        for f in monthly:
+            process_month(f, args.inprocess, settings=settings)
+    elif not process_months(monthly, args.inprocess, args.jobs, settings):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
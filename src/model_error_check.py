@@ -6,16 +6,156 @@
 #    Check start and end time in job.status. Could also get step number from job.out
 # 2. MOM failure with "Error from ocean_thickness_mod: Free surface penetrating rock! Model unstable."
 #    Automatic handling of this with a perturbation shoud depend on how far into the run it got
+#
+# The coupled task's job.out and job.err are scanned for the failure
+# signatures in SIGNATURES (or the JSON file MODEL_ERROR_SIGNATURES, a list of
+# {"name": ..., "pattern": ..., "rerunnable": true/false}) and the last UM
+# timestep. A short run is only resubmitted if none of the signatures found
+# are marked as not rerunnable.
+#
+# Every coupled job of the run is recorded in an SQLite index,
+# MODEL_ERROR_INDEX (default log/failure_index.db in the suite run
+# directory), with its times and classified failure. Only jobs whose
+# job.status changed since the last run are read again. A short run is not
+# resubmitted if the same failure has already been seen in more than
+# MODEL_ERROR_MAX_RECURRENCES (default 3) of the previous
+# MODEL_ERROR_HISTORY (default 20) cycles. If the index can't be read or
+# written, the error is reported and the decision made without the history.
+# model_error_check.py --history prints the recent failures.
 
-import os, time, datetime, re, sys
+#
+# The job.status file may appear after this task starts. It is waited for for
+# up to MODEL_ERROR_CHECK_TIMEOUT seconds (default 300), checking again
+# whenever inotify reports a file created in its directory, or otherwise at
+# intervals growing from POLL_START to POLL_MAX seconds. Files written from
+# another node of a shared filesystem produce no inotify events, so the
+# polling continues alongside it.
 
-def exists_file(file,retry=5):
-    for i in range(retry):
-        if os.path.exists(file):
-            return True
-        else:
-            time.sleep(60)
-    return False
+import os, time, datetime, re, sys, ctypes, ctypes.util, select, mmap, json, collections
+import argparse, glob, sqlite3
+
+POLL_START = 0.1
+POLL_MAX = 30
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+def inotify_watch(directory):
+    """
+    File descriptor reporting files created in directory, or None if
+    inotify isn't available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def exists_file(file, timeout=300):
+    start = time.monotonic()
+    fd = inotify_watch(os.path.dirname(file) or '.')
+    interval = POLL_START
+    try:
+        while True:
+            if os.path.exists(file):
+                print(f"Waited {time.monotonic() - start:.1f} s for {file}")
+                return True
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                print(f"Gave up waiting for {file} after {timeout} s")
+                return False
+            wait = min(interval, remaining)
+            if fd is None:
+                time.sleep(wait)
+            elif select.select([fd], [], [], wait)[0]:
+                # Discard the events, the file is checked at the top of the loop
+                try:
+                    os.read(fd, 65536)
+                except BlockingIOError:
+                    pass
+            interval = min(2 * interval, POLL_MAX)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+# Failure signatures: name, regular expression, whether a resubmission
+# could succeed. A name can be given more than once. Patterns starting with
+# a literal are searched for much faster by re than alternations, so the
+# alternatives are listed separately.
+SIGNATURES = [
+    ('mpi_abort', r'MPI_ABORT was invoked', True),
+    ('mpi_abort', r'application called MPI_Abort', True),
+    ('mom_unstable', r'Free surface penetrating rock', False),
+    ('cice_error', r'abort_ice', False),
+    ('um_error', r'\?\?\?!!!\?\?\?!!!.*ERROR', False),
+    ('walltime', r'PBS: job killed: walltime', False),
+    ('walltime', r'DUE TO TIME LIMIT', False),
+    ('out_of_memory', r'Out Of Memory', False),
+    ('out_of_memory', r'oom-kill', False),
+]
+STEP_PATTERN = r'Atm_Step: Timestep\s+(\d+)'
+# Bytes of log searched at a time, while they are in the CPU cache
+CHUNK = 2**20
+
+# failures maps signature names to the number of matches and the first
+# matching line
+Verdict = collections.namedtuple('Verdict', 'failures last_step rerunnable')
+
+def load_signatures(filename=None):
+    if not filename:
+        return SIGNATURES
+    with open(filename) as f:
+        return [(s['name'], s['pattern'], s.get('rerunnable', False)) for s in json.load(f)]
+
+def chunks(data):
+    """(start, end) of successive blocks of about CHUNK bytes of whole lines"""
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', min(start + CHUNK, len(data)))
+        end = len(data) if end < 0 else end + 1
+        yield start, end
+        start = end
+
+def classify(files, signatures=SIGNATURES):
+    """
+    Scan the log files for the signatures, memory mapped so they aren't
+    read into memory. Each block of the file is read once and searched with
+    each signature's precompiled expression while it is in cache.
+    """
+    regexes = [(name, re.compile(pattern.encode())) for name, pattern, _ in signatures]
+    step_regex = re.compile(STEP_PATTERN.encode())
+    failures = {}
+    last_step = None
+    for file in files:
+        if not os.path.exists(file) or os.path.getsize(file) == 0:
+            continue
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in chunks(data):
+                for name, regex in regexes:
+                    for m in regex.finditer(data, start, end):
+                        if name in failures:
+                            failures[name]['count'] += 1
+                            continue
+                        line_start = data.rfind(b'\n', 0, m.start()) + 1
+                        line_end = data.find(b'\n', m.end())
+                        line = data[line_start:line_end if line_end >= 0 else len(data)]
+                        failures[name] = {'count': 1, 'file': os.path.basename(file),
+                                          'line': line.decode(errors='replace').strip()}
+            # The last timestep is near the end, so search back from there
+            for start, end in reversed(list(chunks(data))):
+                steps = list(step_regex.finditer(data, start, end))
+                if steps:
+                    last_step = int(steps[-1].group(1))
+                    break
+    rerunnable = {name: ok for name, _, ok in signatures}
+    return Verdict(failures, last_step, all(rerunnable[name] for name in failures))
 
 def get_jobnum(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT):
     job_file = os.path.join(CYLC_SUITE_RUN_DIR, 'log', 'job', CYLC_TASK_CYCLE_POINT,
@@ -26,11 +166,11 @@ def get_jobnum(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT):
             return result.group(1)
     raise Exception('Unable to get jobnum')
 
-def check_shortrun(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT):
+def check_shortrun(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT, timeout=300):
     status_file = os.path.join(CYLC_SUITE_RUN_DIR, 'log', 'job', CYLC_TASK_CYCLE_POINT,
                                'coupled', 'NN', 'job.status')
     print(status_file)
-    if exists_file(status_file):
+    if exists_file(status_file, timeout):
         re_init = re.compile('CYLC_JOB_INIT_TIME=([\dT:-]*)')
         re_exit = re.compile('CYLC_JOB_EXIT_TIME=([\dT:-]*)')
         for l in open(status_file).readlines():
@@ -45,17 +185,162 @@ def check_shortrun(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT):
     else:
         raise Exception("No job.status file from coupled task")
 
-CYLC_SUITE_RUN_DIR = os.environ['CYLC_SUITE_RUN_DIR']
-CYLC_TASK_CYCLE_POINT = os.environ['CYLC_TASK_CYCLE_POINT']
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    cycle TEXT, submit INTEGER, init_time TEXT, exit_time TEXT, duration REAL,
+    exit TEXT, last_step INTEGER, rerunnable INTEGER, status_mtime REAL,
+    PRIMARY KEY (cycle, submit));
+CREATE TABLE IF NOT EXISTS failures (
+    cycle TEXT, submit INTEGER, name TEXT, count INTEGER, line TEXT,
+    PRIMARY KEY (cycle, submit, name));
+CREATE INDEX IF NOT EXISTS failures_name ON failures (name, cycle);
+"""
+
+def read_status(status_file):
+    """Init and exit times and the exit status from a job.status file"""
+    status = {}
+    for l in open(status_file).readlines():
+        key, _, value = l.strip().partition('=')
+        status[key] = value
+    times = []
+    for key in ('CYLC_JOB_INIT_TIME', 'CYLC_JOB_EXIT_TIME'):
+        try:
+            times.append(datetime.datetime.fromisoformat(status[key]))
+        except (KeyError, ValueError):
+            times.append(None)
+    return times[0], times[1], status.get('CYLC_JOB_EXIT')
+
+def open_index(filename):
+    db = sqlite3.connect(filename)
+    db.executescript(INDEX_SCHEMA)
+    return db
 
-# This script should only run once to prevent infinite loops.
-# Cylc should take care of this, but for an extra check get the TASK_JOB
-# number from the model job script
-model_task_jobnum = get_jobnum(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT)
-if model_task_jobnum != '01':
-    raise Exception(f'Unexpected run with model_task_jobnum={model_task_jobnum}')
+def update_index(db, CYLC_SUITE_RUN_DIR, signatures=SIGNATURES, verdicts=None):
+    """
+    Add the coupled jobs of every cycle to the index, reading only those
+    whose job.status changed since they were indexed. The logs are only
+    classified for jobs that didn't succeed, and not at all for the job
+    directories in verdicts, which maps them to their Verdict. Jobs whose
+    job.status can't be read are skipped. Returns the number of jobs read.
+    """
+    verdicts = verdicts or {}
+    indexed = {(cycle, submit): mtime for cycle, submit, mtime in
+               db.execute('SELECT cycle, submit, status_mtime FROM jobs')}
+    updated = 0
+    pattern = os.path.join(CYLC_SUITE_RUN_DIR, 'log', 'job', '*', 'coupled', '[0-9]*', 'job.status')
+    for status_file in glob.glob(pattern):
+        job_dir = os.path.dirname(status_file)
+        cycle = os.path.basename(os.path.dirname(os.path.dirname(job_dir)))
+        try:
+            submit = int(os.path.basename(job_dir))
+            mtime = os.path.getmtime(status_file)
+            if indexed.get((cycle, submit)) == mtime:
+                continue
+            t_init, t_exit, exit = read_status(status_file)
+        except (OSError, ValueError) as e:
+            print(f"Skipping {status_file}: {e}", file=sys.stderr)
+            continue
+        duration = (t_exit - t_init).total_seconds() if t_init and t_exit else None
+        if exit == 'SUCCEEDED' or t_exit is None:
+            verdict = Verdict({}, None, True)
+        elif os.path.realpath(job_dir) in verdicts:
+            verdict = verdicts[os.path.realpath(job_dir)]
+        else:
+            verdict = classify([os.path.join(job_dir, 'job.out'),
+                                os.path.join(job_dir, 'job.err')], signatures)
+        with db:
+            db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (cycle, submit, t_init and t_init.isoformat(),
+                        t_exit and t_exit.isoformat(), duration, exit,
+                        verdict.last_step, verdict.rerunnable, mtime))
+            db.execute('DELETE FROM failures WHERE cycle = ? AND submit = ?', (cycle, submit))
+            db.executemany('INSERT INTO failures VALUES (?, ?, ?, ?, ?)',
+                           [(cycle, submit, name, f['count'], f['line'])
+                            for name, f in verdict.failures.items()])
+        updated += 1
+    return updated
+
+def recurrences(db, names, before_cycle, history):
+    """
+    Number of the last history cycles before before_cycle that had each of
+    the failures in names
+    """
+    cycles = [c for c, in db.execute(
+        'SELECT DISTINCT cycle FROM jobs WHERE cycle < ? ORDER BY cycle DESC LIMIT ?',
+        (before_cycle, history))]
+    if not cycles:
+        return {name: 0 for name in names}
+    return {name: db.execute(
+        'SELECT COUNT(DISTINCT cycle) FROM failures WHERE name = ? AND cycle BETWEEN ? AND ?',
+        (name, cycles[-1], cycles[0])).fetchone()[0] for name in names}
+
+def print_history(db, limit):
+    for row in db.execute(
+            'SELECT jobs.cycle, jobs.submit, duration, exit, last_step, '
+            "group_concat(name || '*' || count, ' ') FROM jobs JOIN failures "
+            'USING (cycle, submit) GROUP BY jobs.cycle, jobs.submit '
+            'ORDER BY jobs.cycle DESC, jobs.submit DESC LIMIT ?', (limit,)):
+        print("%s %02d %8s s %-10s step %-8s %s" % row)
+
+def main():
+    parser = argparse.ArgumentParser(description="Diagnose a coupled model failure and decide on resubmission")
+    parser.add_argument('--history', type=int, nargs='?', const=50, metavar='N',
+                        help="Update the failure index and print the last N failed jobs")
+    args = parser.parse_args()
+
+    CYLC_SUITE_RUN_DIR = os.environ['CYLC_SUITE_RUN_DIR']
+    TIMEOUT = float(os.environ.get('MODEL_ERROR_CHECK_TIMEOUT', 300))
+    SIGNATURE_FILE = os.environ.get('MODEL_ERROR_SIGNATURES')
+    INDEX = os.environ.get('MODEL_ERROR_INDEX',
+                           os.path.join(CYLC_SUITE_RUN_DIR, 'log', 'failure_index.db'))
+    MAX_RECURRENCES = int(os.environ.get('MODEL_ERROR_MAX_RECURRENCES', 3))
+    HISTORY = int(os.environ.get('MODEL_ERROR_HISTORY', 20))
+    signatures = load_signatures(SIGNATURE_FILE)
+
+    if args.history is not None:
+        db = open_index(INDEX)
+        print("Indexed", update_index(db, CYLC_SUITE_RUN_DIR, signatures), "jobs")
+        print_history(db, args.history)
+        return
+
+    CYLC_TASK_CYCLE_POINT = os.environ['CYLC_TASK_CYCLE_POINT']
+
+    # This script should only run once to prevent infinite loops.
+    # Cylc should take care of this, but for an extra check get the TASK_JOB
+    # number from the model job script
+    model_task_jobnum = get_jobnum(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT)
+    if model_task_jobnum != '01':
+        raise Exception(f'Unexpected run with model_task_jobnum={model_task_jobnum}')
+
+    job_dir = os.path.join(CYLC_SUITE_RUN_DIR, 'log', 'job', CYLC_TASK_CYCLE_POINT,
+                           'coupled', 'NN')
+    # The logs are only complete once job.status has been written
+    shortrun = check_shortrun(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT, TIMEOUT)
+    verdict = classify([os.path.join(job_dir, 'job.out'), os.path.join(job_dir, 'job.err')],
+                       signatures)
+    print("Verdict", json.dumps(verdict._asdict()))
+
+    # A failure recurring in earlier cycles is unlikely to go away on a rerun.
+    # This job's logs have just been classified, after job.status was
+    # written, so that verdict is indexed rather than reading them again.
+    try:
+        db = open_index(INDEX)
+        print("Indexed", update_index(db, CYLC_SUITE_RUN_DIR, signatures,
+                                      {os.path.realpath(job_dir): verdict}), "jobs")
+        recurring = {name: n for name, n in
+                     recurrences(db, verdict.failures, CYLC_TASK_CYCLE_POINT, HISTORY).items()
+                     if n > MAX_RECURRENCES}
+    except (sqlite3.Error, OSError) as e:
+        print(f"Can't use the failure index {INDEX}, ignoring earlier cycles: {e}",
+              file=sys.stderr)
+        recurring = {}
+    if recurring:
+        print(f"Failures seen in earlier cycles: {recurring}")
+
+    if shortrun and verdict.rerunnable and not recurring:
+        sys.exit(0)
+    else:
+        raise Exception('Rerunnable early failure not found')
 
-if check_shortrun(CYLC_SUITE_RUN_DIR, CYLC_TASK_CYCLE_POINT):
-    sys.exit(0)
-else:
-    raise Exception('Rerunnable early failure not found')
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,212 @@
 
 # Call with ocean_scalar.nc as argument
 
-import sys, netCDF4, argparse
+# With --state FILE, the number of records checked and the worst values so
+# far are kept in FILE, and later checks only read the records added since.
+# The state is started again when the input is a different file (another
+# inode or first time), e.g. for the next cycle.
+# With --watch SECONDS, the file is checked again every SECONDS until a limit
+# is exceeded (or the process is killed), so that the run can be stopped soon
+# after the ocean becomes unstable.
+
+# By default only ke_tot is checked against --kmax. --rules FILE checks the
+# rules in a JSON file instead, a list of
+#   {"variable": "ke_tot", "type": "max", "threshold": 1500}
+# where type is one of
+#   max        value above threshold
+#   min        value below threshold
+#   abs_delta  change between consecutive records larger than threshold
+#   slope      least squares slope over "window" records larger than
+#              threshold per record, in either direction
+# Every rule is reported, and the run stops if any is tripped. A variable with
+# axes other than time, such as ke_tot(time, scalar_axis), is checked at every
+# point.
+
+import sys, os, json, time, argparse
+import numpy as np, netCDF4
 
 parser = argparse.ArgumentParser(description="Check ocean KE")
 parser.add_argument('--kmax', dest='kmax', type=float,
                     default=1500, help="KE limit")
+parser.add_argument('--rules', help="JSON file of rules to check instead of --kmax")
+parser.add_argument('--state', help="File to keep the records already checked in")
+parser.add_argument('--watch', type=float, metavar='SECONDS',
+                    help="Keep checking the file at this interval")
 
 parser.add_argument('input', help='Input ocean scalar file')
 args = parser.parse_args()
 
-d = netCDF4.Dataset(args.input)
+RULE_TYPES = ('max', 'min', 'abs_delta', 'slope')
+
+def read_rules(filename):
+    if not filename:
+        return [{'variable': 'ke_tot', 'type': 'max', 'threshold': args.kmax}]
+    with open(filename) as f:
+        rules = json.load(f)
+    for rule in rules:
+        if rule['type'] not in RULE_TYPES:
+            raise ValueError("Unknown rule type %s, expected one of %s" % (rule['type'], RULE_TYPES))
+        if rule['type'] == 'slope' and rule.get('window', 0) < 2:
+            raise ValueError("slope rule for %s needs a window of at least 2 records" % rule['variable'])
+    return rules
+
+def rule_name(rule):
+    if rule['type'] == 'slope':
+        return "%s slope(%d) %g" % (rule['variable'], rule['window'], rule['threshold'])
+    return "%s %s %g" % (rule['variable'], rule['type'], rule['threshold'])
+
+def new_state():
+    return {'file': None, 'records': {}, 'tails': {}, 'worst': {}, 'rules': rules}
+
+def file_identity(d):
+    """Device, inode and first time of the open input file d"""
+    st = os.stat(args.input)
+    time = d.variables.get('time')
+    first = float(time[0]) if time is not None and time.shape[0] else None
+    return [st.st_dev, st.st_ino, first]
+
+def read_state(filename):
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+    except (TypeError, FileNotFoundError):
+        return new_state()
+    if not isinstance(state.get('records'), dict):
+        # Written by an older version, without the rules
+        return new_state()
+    return state
+
+def write_state(filename, state):
+    if filename:
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, filename)
+
+def evaluate(rule, values, first):
+    """
+    Worst value of the rule over values [record, point], whose first
+    record is record first, and the record it occurs at. values holds the
+    earlier records needed for differences and windows.
+    """
+    kind = rule['type']
+    if kind == 'max':
+        metric = values
+    elif kind == 'min':
+        metric = -values
+    elif kind == 'abs_delta':
+        metric = np.abs(np.diff(values, axis=0))
+        first += 1
+    else:
+        window = rule['window']
+        if len(values) < window:
+            return None, None
+        # Slope of each window is its dot product with these weights
+        x = np.arange(window) - (window - 1) / 2
+        weights = x / (x**2).sum()
+        windows = np.lib.stride_tricks.sliding_window_view(values, window, axis=0)
+        metric = np.abs(windows @ weights)
+        first += window - 1
+    # Ignore missing values
+    metric = np.where(np.isnan(metric), -np.inf, metric)
+    if metric.size == 0 or np.isneginf(metric).all():
+        return None, None
+    i = int(np.argmax(metric))
+    worst = float(metric.flat[i])
+    return (-worst if kind == 'min' else worst), first + i // metric.shape[1]
+
+def tripped(rule, value):
+    if value is None:
+        return False
+    if rule['type'] == 'min':
+        return value < rule['threshold']
+    return value > rule['threshold']
+
+def check(state, rules):
+    # Only read the records added since the last check, with as many before
+    # them as the abs_delta and slope rules need
+    context = {}
+    for rule in rules:
+        n = {'abs_delta': 1, 'slope': rule.get('window', 1) - 1}.get(rule['type'], 0)
+        context[rule['variable']] = max(context.get(rule['variable'], 0), n)
+
+    with netCDF4.Dataset(args.input) as d:
+        identity = file_identity(d)
+        if identity != state.get('file') or any(
+                name not in d.variables or d.variables[name].shape[0] < n
+                for name, n in state['records'].items()):
+            # A new file, e.g. for the next cycle
+            state = new_state()
+            state['file'] = identity
+        for name in context:
+            var = d.variables[name]
+            nrec = var.shape[0]
+            checked = state['records'].get(name, 0)
+            if nrec == checked:
+                continue
+            # One row of all the points of each record
+            new = np.ma.filled(var[checked:].astype(float), np.nan).reshape(nrec - checked, -1)
+            tail = np.reshape(np.asarray(state['tails'].get(name, []), float), (-1, new.shape[1]))
+            values = np.concatenate([tail, new])
+            for i, rule in enumerate(rules):
+                if rule['variable'] != name:
+                    continue
+                value, record = evaluate(rule, values, checked - len(tail))
+                key = str(i)
+                previous = state['worst'].get(key)
+                if value is not None and (previous is None or
+                                          (value < previous[0] if rule['type'] == 'min'
+                                           else value > previous[0])):
+                    state['worst'][key] = [value, record]
+            state['records'][name] = nrec
+            state['tails'][name] = values[len(values)-context[name]:].tolist() if context[name] else []
+    return state
 
-ke = d.variables['ke_tot'][:]
-kmax = ke.max()
-print('Max ocean KE %.0f' % kmax)
+def report(state, rules):
+    """Print the status of every rule. Returns the number tripped"""
+    failures = 0
+    for i, rule in enumerate(rules):
+        worst = state['worst'].get(str(i))
+        if worst is None:
+            print("  ---- %s: no valid data" % rule_name(rule))
+            continue
+        status = 'FAIL' if tripped(rule, worst[0]) else 'PASS'
+        failures += status == 'FAIL'
+        print("  %s %s: %g at record %d" % (status, rule_name(rule), worst[0], worst[1]))
+    return failures
 
-if kmax > args.kmax:
-    print("Stopping run because ocean KE %.0f exceeds limit" % kmax, file=sys.stderr)
-    sys.exit(1)
+rules = read_rules(args.rules)
+state = read_state(args.state)
+if state.get('rules', rules) != rules:
+    # The worst values are kept for each rule, so start again
+    state = new_state()
+state['rules'] = rules
+while True:
+    checked = state.get('file'), dict(state['records'])
+    try:
+        state = check(state, rules)
+    except OSError as e:
+        # Not written yet, or being written
+        if not args.watch:
+            raise
+        print("Can't read %s: %s" % (args.input, e), file=sys.stderr)
+    else:
+        write_state(args.state, state)
+        # When watching, only report new records
+        if not args.watch or (state['file'], state['records']) != checked:
+            if not args.rules and 'ke_tot' in state['records']:
+                if '0' in state['worst']:
+                    print('Max ocean KE %.0f' % state['worst']['0'][0])
+                else:
+                    # Every value so far missing
+                    print('Max ocean KE: no valid data')
+            failures = report(state, rules)
+            if failures:
+                if args.rules:
+                    print("Stopping run because %d of %d stability rules failed" % (failures, len(rules)), file=sys.stderr)
+                else:
+                    print("Stopping run because ocean KE %.0f exceeds limit" % state['worst']['0'][0], file=sys.stderr)
+                sys.exit(1)
+    if not args.watch:
+        break
+    time.sleep(args.watch)
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Benchmark the ozone redistribution pipeline on synthetic input.
+
+Writes synthetic um2netcdf style monthly files (orography, density and
+tropopause), an orography file and a year of ozone at N96, N216 or N512, then
+times each stage of the pipeline:
+
+    setup_ozone_input, load, climatology, interpolation, redistribution,
+    mass_budget, save
+
+recording wall time, CPU time and peak RSS for each (see
+redistribute_ozone.StageTimer).  Results can be written
+as JSON and compared against an earlier run, so changes to
+setup_ozone_input.py and redistribute_ozone.py can be checked offline.
+
+Example usage:
+
+# Generate N216 input once, then benchmark it and save a baseline
+python ./ozone_benchmark.py generate -r N216 -d /scratch/$USER/ozone_bench
+python ./ozone_benchmark.py run -r N216 -d /scratch/$USER/ozone_bench --results baseline.json
+
+# After changing the scripts, compare against the baseline
+python ./ozone_benchmark.py run -r N216 -d /scratch/$USER/ozone_bench --baseline baseline.json
+
+Without -d, run generates its input in a temporary directory which is removed
+afterwards.
+
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import cf_units
+import iris
+import iris.coord_systems
+from iris.coords import AuxCoord, DimCoord
+from iris.cube import Cube
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import redistribute_ozone  # noqa: E402
+import vertical_levels  # noqa: E402
+
+# Number of latitudes and longitudes of the ENDGame grids
+RESOLUTIONS = {
+    'N96': (144, 192),
+    'N216': (324, 432),
+    'N512': (768, 1024),
+}
+NLEV = len(vertical_levels.level_set().sigma)
+MODEL_TOP = 85000.  # m
+EARTH_RADIUS = 6371229.  # m
+
+# Ozone year to redistribute; the density and tropopause are for the two
+# years before it
+OZONE_YEAR = 2000
+
+# Written to the data directory after the synthetic input, recording its
+# resolution
+INPUT_RECORD = 'synthetic_input.json'
+
+TIME_UNITS = cf_units.Unit('days since 1970-01-01 00:00:00',
+                           calendar='proleptic_gregorian')
+
+
+def theta_heights():
+    """Synthetic theta level heights (m), quadratically stretched."""
+    return MODEL_TOP * (np.arange(1, NLEV+1) / NLEV)**2
+
+
+def sigma_values(heights):
+    """Synthetic sigma, decaying to 0 at the 51st theta level."""
+    eta = heights / MODEL_TOP
+    eta_flat = theta_heights()[50] / MODEL_TOP
+    return np.where(eta < eta_flat, (1. - eta/eta_flat)**2, 0.)
+
+
+def rho_heights():
+    """Synthetic rho level heights (m), half way between theta levels."""
+    theta = theta_heights()
+    return (np.concatenate([[0.], theta[:-1]]) + theta) / 2.
+
+
+def horizontal_coords(nlat, nlon, bounds=True):
+    """Latitude and longitude of the ENDGame grid with nlat x nlon points."""
+    cs = iris.coord_systems.GeogCS(EARTH_RADIUS)
+    latitude = DimCoord((np.arange(nlat) + 0.5) * 180. / nlat - 90.,
+                        standard_name='latitude', units='degrees',
+                        coord_system=cs)
+    longitude = DimCoord((np.arange(nlon) + 0.5) * 360. / nlon,
+                         standard_name='longitude', units='degrees',
+                         coord_system=cs, circular=True)
+    if bounds:
+        latitude.guess_bounds()
+        longitude.guess_bounds()
+    return latitude, longitude
+
+
+def month_time(year, month, bounds=True):
+    """Time coordinate for the middle of a month, optionally with bounds."""
+    start = datetime.datetime(year, month, 1)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    # date2num gives integers for whole days, so make every month float64
+    # or the months can't be concatenated
+    points = np.array([TIME_UNITS.date2num(start + (end - start) / 2)],
+                      dtype=np.float64)
+    bound_values = None
+    if bounds:
+        bound_values = np.array([[TIME_UNITS.date2num(start),
+                                  TIME_UNITS.date2num(end)]], dtype=np.float64)
+    return DimCoord(points, bounds=bound_values, standard_name='time',
+                    units=TIME_UNITS)
+
+
+def orography_field(nlat, nlon):
+    """Smooth synthetic orography (m), 0 to about 3km."""
+    lat = np.radians((np.arange(nlat) + 0.5) * 180. / nlat - 90.)
+    lon = np.radians((np.arange(nlon) + 0.5) * 360. / nlon)
+    orog = 1500. * (1. + np.sin(3.*lon)[np.newaxis, :] *
+                    np.cos(2.*lat)[:, np.newaxis]) * np.cos(lat)[:, np.newaxis]
+    return orog.astype(np.float32)
+
+
+def tropopause_field(nlat, nlon, month):
+    """Synthetic tropopause altitude (m): high in the tropics, seasonal."""
+    lat = np.radians((np.arange(nlat) + 0.5) * 180. / nlat - 90.)
+    lon = np.radians((np.arange(nlon) + 0.5) * 360. / nlon)
+    season = np.cos(2. * np.pi * (month - 1) / 12.)
+    trop = (16500. - 7000. * np.sin(lat)**2 + 800. * season * np.sin(lat))
+    trop = trop[:, np.newaxis] + 200. * np.cos(2.*lon)[np.newaxis, :]
+    return trop.astype(np.float32)
+
+
+def density_field(heights, nlat, nlon):
+    """Synthetic density*r*r (kg/m): exponential in height."""
+    rhoa2 = 1.225 * np.exp(-heights / 7000.) * (EARTH_RADIUS + heights)**2
+    return np.broadcast_to(rhoa2[:, np.newaxis, np.newaxis],
+                           (NLEV, nlat, nlon)).astype(np.float32)
+
+
+def ozone_field(heights, nlat, nlon, month):
+    """Synthetic ozone mass mixing ratio with a stratospheric peak."""
+    lat = np.radians((np.arange(nlat) + 0.5) * 180. / nlat - 90.)
+    peak = 8.e-6 * (1. + 0.2 * np.cos(2. * np.pi * month / 12.) * np.sin(lat))
+    profile = np.exp(-((heights - 30000.) / 9000.)**2)
+    ozone = 4.e-8 + profile[:, np.newaxis] * peak[np.newaxis, :]
+    return np.broadcast_to(ozone[:, :, np.newaxis],
+                           (NLEV, nlat, nlon)).astype(np.float32)
+
+
+def um_month_cubes(year, month, nlat, nlon):
+    """
+    Cubes for one month of um2netcdf output read by setup_ozone_input.py.
+
+    Only var_names are set, as that is how setup_ozone_input.py finds them.
+
+    """
+    latitude, longitude = horizontal_coords(nlat, nlon, bounds=False)
+    time_coord = month_time(year, month, bounds=False)
+
+    orog = Cube(orography_field(nlat, nlon)[np.newaxis], var_name='fld_s00i033',
+                units='m')
+    trop = Cube(tropopause_field(nlat, nlon, month)[np.newaxis],
+                var_name='fld_s30i453', units='m')
+    for cube in (orog, trop):
+        cube.add_dim_coord(time_coord.copy(), 0)
+        cube.add_dim_coord(latitude.copy(), 1)
+        cube.add_dim_coord(longitude.copy(), 2)
+
+    heights = rho_heights()
+    level_height = DimCoord(heights, standard_name=(
+        'atmosphere_hybrid_height_coordinate'), var_name='rho_level_height',
+        units='m', attributes={'comments': 'height above sea level at the '
+                                           'top of the model'})
+    rho = Cube(density_field(heights, nlat, nlon)[np.newaxis],
+               var_name='fld_s00i253', units='kg m-1')
+    rho.add_dim_coord(time_coord.copy(), 0)
+    rho.add_dim_coord(level_height, 1)
+    rho.add_dim_coord(latitude.copy(), 2)
+    rho.add_dim_coord(longitude.copy(), 3)
+
+    return [orog, rho, trop]
+
+
+def ozone_cube(year, nlat, nlon):
+    """A year of synthetic ozone on theta levels, like the ozone ancillary."""
+    latitude, longitude = horizontal_coords(nlat, nlon)
+    heights = theta_heights()
+    data = np.stack([ozone_field(heights, nlat, nlon, month)
+                     for month in range(1, 13)])
+    cube = Cube(data, standard_name='mass_fraction_of_ozone_in_air',
+                units='1')
+    times = [month_time(year, month) for month in range(1, 13)]
+    time_coord = DimCoord(
+        np.concatenate([t.points for t in times]),
+        bounds=np.concatenate([t.bounds for t in times]),
+        standard_name='time', units=TIME_UNITS)
+    cube.add_dim_coord(time_coord, 0)
+    cube.add_dim_coord(DimCoord(np.arange(1, NLEV+1, dtype=np.int32),
+                                standard_name='model_level_number', units='1'),
+                       1)
+    bounds = np.stack([rho_heights(),
+                       np.append(rho_heights()[1:], MODEL_TOP)], axis=1)
+    # Like the ancillary, level_height has no standard_name, so that it is
+    # found by that name when the file is read back
+    cube.add_aux_coord(AuxCoord(heights, bounds=bounds,
+                                long_name='level_height',
+                                var_name='level_height', units='m'), 1)
+    cube.add_aux_coord(AuxCoord(sigma_values(heights),
+                                bounds=sigma_values(bounds),
+                                long_name='sigma', var_name='sigma',
+                                units='1'), 1)
+    cube.add_dim_coord(latitude, 2)
+    cube.add_dim_coord(longitude, 3)
+    return cube
+
+
+def generate(resolution, data_dir):
+    """Write synthetic inputs at 'resolution' into 'data_dir'."""
+    nlat, nlon = RESOLUTIONS[resolution]
+    um_dir = os.path.join(data_dir, 'um')
+    os.makedirs(um_dir, exist_ok=True)
+
+    latitude, longitude = horizontal_coords(nlat, nlon)
+    orog = Cube(orography_field(nlat, nlon), standard_name='surface_altitude',
+                units='m')
+    orog.add_dim_coord(latitude, 0)
+    orog.add_dim_coord(longitude, 1)
+    iris.save(orog, os.path.join(data_dir, 'orography.nc'))
+
+    iris.save(ozone_cube(OZONE_YEAR, nlat, nlon),
+              os.path.join(data_dir, 'ozone.nc'))
+
+    for year in (OZONE_YEAR - 2, OZONE_YEAR - 1):
+        for month in range(1, 13):
+            filename = 'um.{:04d}-{:02d}.nc'.format(year, month)
+            iris.save(um_month_cubes(year, month, nlat, nlon),
+                      os.path.join(um_dir, filename))
+    with open(os.path.join(data_dir, INPUT_RECORD), 'w') as f:
+        json.dump({'resolution': resolution}, f)
+    print('Synthetic {} input written to {}'.format(resolution, data_dir))
+
+
+def generated_resolution(data_dir):
+    """
+    Resolution of the synthetic input in 'data_dir', or None if there is none.
+
+    Raises ValueError if there is input without a record of its resolution.
+
+    """
+    try:
+        with open(os.path.join(data_dir, INPUT_RECORD)) as f:
+            return json.load(f)['resolution']
+    except FileNotFoundError:
+        if os.path.exists(os.path.join(data_dir, 'ozone.nc')):
+            msg = ('{} has input of unknown resolution, from an older version '
+                   'or an interrupted generate; remove it or use another -d')
+            raise ValueError(msg.format(data_dir))
+        return None
+
+
+def run_setup(data_dir, setup_dir, results):
+    """Time setup_ozone_input.py on each synthetic month."""
+    os.makedirs(setup_dir, exist_ok=True)
+    script = os.path.join(SCRIPT_DIR, 'setup_ozone_input.py')
+    inputs = sorted(glob.glob(os.path.join(data_dir, 'um', 'um.*.nc')))
+    wall = time.perf_counter()
+    cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+    for input_file in inputs:
+        output = os.path.join(setup_dir, os.path.basename(input_file))
+        subprocess.check_call([sys.executable, script, input_file, output])
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    results.append({
+        'stage': 'setup_ozone_input',
+        'wall': time.perf_counter() - wall,
+        'cpu': (usage.ru_utime + usage.ru_stime) - (cpu.ru_utime + cpu.ru_stime),
+        # Largest of the child processes, not of this one
+        'peak_rss': usage.ru_maxrss * 1024,
+    })
+
+
+def run_redistribution(data_dir, setup_dir, lazy, results):
+    """Time each stage of redistribute_ozone.process."""
+    # iris.load expands the wildcards itself
+    setup_files = os.path.join(setup_dir, 'um.*.nc')
+    arg_list = [
+        '-o', os.path.join(data_dir, 'benchmark_output.anc'),
+        '-t', setup_files,
+        '-r', os.path.join(data_dir, 'orography.nc'),
+        '-d', setup_files,
+        '-z', os.path.join(data_dir, 'ozone.nc'),
+        '-y', str(OZONE_YEAR),
+    ]
+    if lazy:
+        arg_list.append('--lazy')
+    args = redistribute_ozone.get_arg_parser().parse_args(arg_list)
+    timer = redistribute_ozone.StageTimer()
+    redistribute_ozone.process(args, timer=timer)
+    results.extend(timer.stages)
+
+
+def report(results, baseline=None):
+    """Print a table of stage timings, with speed-ups against 'baseline'."""
+    base = {}
+    if baseline:
+        base = {stage['stage']: stage for stage in baseline['stages']}
+    print('{:<20} {:>10} {:>10} {:>12} {:>10}'.format(
+        'stage', 'wall (s)', 'cpu (s)', 'peak (MiB)', 'speed-up'))
+    for stage in results['stages']:
+        speedup = ''
+        if stage['stage'] in base and stage['wall'] > 0:
+            speedup = '{:.2f}x'.format(base[stage['stage']]['wall'] /
+                                       stage['wall'])
+        print('{:<20} {:>10.3f} {:>10.3f} {:>12.1f} {:>10}'.format(
+            stage['stage'], stage['wall'], stage['cpu'],
+            stage['peak_rss'] / 2.**20, speedup))
+
+
+def run(args):
+    """Generate input if needed, run the benchmark and report the results."""
+    data_dir = args.data_dir
+    remove = False
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='ozone_benchmark_')
+        remove = not args.keep
+    try:
+        resolution = generated_resolution(data_dir)
+        if resolution is None:
+            generate(args.resolution, data_dir)
+        elif resolution != args.resolution:
+            msg = '{} has {} input, not {}; use -r {} or another -d'
+            raise ValueError(msg.format(data_dir, resolution, args.resolution,
+                                        resolution))
+        setup_dir = os.path.join(data_dir, 'setup')
+        results = {'resolution': args.resolution, 'lazy': args.lazy,
+                   'stages': []}
+        run_setup(data_dir, setup_dir, results['stages'])
+        run_redistribution(data_dir, setup_dir, args.lazy, results['stages'])
+    finally:
+        if remove:
+            shutil.rmtree(data_dir)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def get_arg_parser(docs=None):
+    """CLI argument parser for the generate and run commands."""
+    parser = argparse.ArgumentParser(
+        description=docs,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser(
+        'generate', help='Write synthetic input files')
+    generate_parser.add_argument(
+        '-d', '--data_dir', required=True,
+        help='Directory to write the synthetic input to')
+
+    run_parser = commands.add_parser(
+        'run', help='Benchmark the ozone pipeline')
+    run_parser.add_argument(
+        '-d', '--data_dir', default=None,
+        help='Directory of synthetic input, generated if it is missing.  '
+             'Must have been generated at the same resolution.  Defaults to '
+             'a temporary directory')
+    run_parser.add_argument(
+        '--keep', action='store_true',
+        help='Keep the temporary directory used when -d is not given')
+    run_parser.add_argument(
+        '--lazy', action='store_true',
+        help='Run redistribute_ozone with --lazy')
+    run_parser.add_argument(
+        '--results', default=None,
+        help='JSON file to write the results to')
+    run_parser.add_argument(
+        '--baseline', default=None,
+        help='JSON results of an earlier run to compare against')
+
+    for subparser in (generate_parser, run_parser):
+        subparser.add_argument(
+            '-r', '--resolution', choices=sorted(RESOLUTIONS), default='N96',
+            help='Grid resolution')
+
+    return parser
+
+
+if __name__ == '__main__':
+    arg_parser = get_arg_parser(__doc__)
+    args = arg_parser.parse_args()
+    if args.command == 'generate':
+        generate(args.resolution, args.data_dir)
+    else:
+        run(args)
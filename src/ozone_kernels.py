@@ -0,0 +1,188 @@
+"""
+Column calculations of the ozone redistribution on plain numpy arrays, used by
+redistribute_ozone.py.
+
+These need neither iris nor ANTS, so they can be tested on their own.
+
+"""
+import numpy as np
+
+# Ozone mass mixing ratio at the ozone tropopause
+TROPOPAUSE_OZONE = 1.32e-7  # 80ppbv
+
+
+def centred_difference(values, axis=0):
+    """
+    Spacing of the points in 'values' along 'axis'.
+
+    Uses the centred difference (x[i+1] - x[i-1])/2 for interior points and
+    one-sided differences at the first and last points.  The result is always
+    float64, whatever the precision of 'values'.
+
+    """
+    values = np.asarray(values)
+    values = np.moveaxis(values, axis, 0)
+    if values.shape[0] < 2:
+        msg = 'Need at least 2 points along axis {} to form differences, got {}'
+        raise ValueError(msg.format(axis, values.shape[0]))
+    spacing = np.empty(values.shape, dtype=np.float64)
+    spacing[1:-1] = (values[2:] - values[:-2])/2.
+    spacing[0] = values[1] - values[0]
+    spacing[-1] = values[-1] - values[-2]
+    return np.moveaxis(spacing, 0, axis)
+
+
+def first_level_above(hz, threshold, name):
+    """
+    Index of the first level in each column that is higher than 'threshold'.
+
+    'hz' holds the level altitudes [nlev,nlat] and 'threshold' the height to
+    exceed in each column [nmonth,nlat].  Returns indices [nmonth,nlat].
+
+    """
+    above = hz[np.newaxis, :, :] > threshold[:, np.newaxis, :]
+    if not above.any(axis=1).all():
+        msg = 'No model level is above the {} in some columns'
+        raise ValueError(msg.format(name))
+    return above.argmax(axis=1)
+
+
+def log_linear_blend(hz, lower, upper, log_lower, log_upper):
+    """
+    Interpolate log(ozone) linearly in height between two levels per column.
+
+    'lower' and 'upper' are the level indices [nmonth,nlat] of the end points,
+    where log(ozone) takes the values 'log_lower' and 'log_upper'.  Returns
+    the interpolated values on all levels [nmonth,nlev,nlat], which are only
+    meaningful between 'lower' (inclusive) and 'upper' (exclusive).
+
+    This is the arithmetic np.interp uses for a 2-point table, so the result
+    is identical to interpolating one column at a time.
+
+    """
+    lat = np.arange(hz.shape[1])[np.newaxis, :]
+    height = hz[np.newaxis, :, :]
+    height0 = hz[lower, lat][:, np.newaxis, :]
+    height1 = hz[upper, lat][:, np.newaxis, :]
+    value0 = np.broadcast_to(
+        np.asarray(log_lower, dtype=np.float64), lower.shape)[:, np.newaxis, :]
+    value1 = np.broadcast_to(
+        np.asarray(log_upper, dtype=np.float64), upper.shape)[:, np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        slope = (value1 - value0)/(height1 - height0)
+        blend = slope*(height - height0) + value0
+        # Like np.interp, work from the upper point if the lower one gives
+        # NaN, and take the end point value exactly at the lower level.
+        blend = np.where(np.isnan(blend),
+                         slope*(height - height1) + value1, blend)
+        blend = np.where(np.isnan(blend) & (value0 == value1), value0, blend)
+        blend = np.where(height == height0, value0, blend)
+    return blend
+
+
+def redistribute_columns(oz_zm, hz_zm, th_zm):
+    """
+    Redistribute zonal mean ozone about the dynamical tropopause.
+
+    'oz_zm' is the zonal mean ozone [nmonth,nlev,nlat], 'hz_zm' the zonal
+    mean level altitudes [nlev,nlat] and 'th_zm' the zonal mean dynamical
+    tropopause altitude [nmonth,nlat], all heights in m.  Every (month,
+    latitude) column is handled at once:
+
+    * Ozone is set to 80ppbv at the ozone tropopause, the first level more
+      than 1km below the dynamical tropopause, and log(ozone) is interpolated
+      in height up to the original value one level above the first level
+      more than 2km above the dynamical tropopause.
+    * Where the original ozone at the ozone tropopause is below 80ppbv,
+      log(ozone) is also interpolated down to the original value at the first
+      level more than 3km below the dynamical tropopause.
+    * Where it is above 80ppbv, ozone is held at 80ppbv down to the highest
+      level where the original ozone is below 80ppbv.
+
+    Returns the redistributed ozone, with the same type and dtype as 'oz_zm'.
+
+    """
+    oz_dat = np.ma.getdata(oz_zm)
+    hz_zm = np.asarray(hz_zm, dtype=np.float64)
+    nmonth, nlev, nlat = oz_dat.shape
+    month = np.arange(nmonth)[:, np.newaxis]
+    lat = np.arange(nlat)[np.newaxis, :]
+    level = np.arange(nlev)[np.newaxis, :, np.newaxis]
+    trop_oz = oz_dat.dtype.type(TROPOPAUSE_OZONE)
+
+    counter_dyntrop = first_level_above(
+        hz_zm, th_zm - 1000., 'ozone tropopause')
+    counter_highoz = first_level_above(
+        hz_zm, th_zm + 2000., 'dynamical tropopause + 2km') + 1
+    if (counter_highoz >= nlev).any():
+        raise ValueError('Top of the ozone interpolation is above the model top')
+    counter_lowoz = first_level_above(
+        hz_zm, th_zm - 3000., 'dynamical tropopause - 3km')
+    oz_dyntrop = oz_dat[month, counter_dyntrop, lat]
+
+    oz_redist = oz_zm.copy()
+
+    # Linearly interpolate log(ozone) in height between 80ppbv at the ozone
+    # tropopause and the highoz values
+    blend = log_linear_blend(hz_zm, counter_dyntrop, counter_highoz,
+                             np.log(trop_oz),
+                             np.log(oz_dat[month, counter_highoz, lat]))
+    in_blend = ((level >= counter_dyntrop[:, np.newaxis, :]) &
+                (level < counter_highoz[:, np.newaxis, :]))
+    oz_redist[in_blend] = np.exp(blend[in_blend])
+
+    # If orig ozone is < 80ppbv at the ozone tropopause, linearly interpolate
+    # log(ozone) in height down to the lowoz values
+    below = oz_dyntrop < TROPOPAUSE_OZONE
+    blend = log_linear_blend(hz_zm, counter_lowoz, counter_dyntrop,
+                             np.log(oz_dat[month, counter_lowoz, lat]),
+                             np.log(np.ma.getdata(
+                                 oz_redist[month, counter_dyntrop, lat])))
+    in_blend = ((level >= counter_lowoz[:, np.newaxis, :]) &
+                (level < counter_dyntrop[:, np.newaxis, :]) &
+                below[:, np.newaxis, :])
+    oz_redist[in_blend] = np.exp(blend[in_blend])
+
+    # If orig ozone is > 80ppbv at the ozone tropopause, keep at 80ppbv
+    # down to the height where it becomes 80ppbv
+    above = oz_dyntrop > TROPOPAUSE_OZONE
+    low_oz = oz_dat < TROPOPAUSE_OZONE
+    if (above & ~low_oz.any(axis=1)).any():
+        raise ValueError('Ozone is above 80ppbv throughout some columns')
+    counter_oztrop = nlev - 1 - low_oz[:, ::-1, :].argmax(axis=1)
+    in_plateau = ((level > counter_oztrop[:, np.newaxis, :]) &
+                  (level < counter_dyntrop[:, np.newaxis, :]) &
+                  above[:, np.newaxis, :])
+    oz_redist[in_plateau] = trop_oz
+
+    return oz_redist
+
+
+def cell_volume(coslat, dlat, dz2d):
+    """
+    Volume of each zonal band cell per unit radius squared [nlev,nlat].
+
+    This is 2*pi*cos(lat)*dlat*dz, the weight used to integrate zonal mean
+    ozone mass.
+
+    """
+    return (coslat*2.*np.pi*dlat)[np.newaxis, :]*dz2d
+
+
+def stratospheric_scaling(oz_redist, oz_zm, rho_zm, volume, stratosphere):
+    """
+    Factor (S+dT)/S for each month that conserves the global ozone mass.
+
+    dT is the ozone mass removed by the redistribution from 'oz_zm' to
+    'oz_redist' and S the mass of redistributed ozone in the 'stratosphere'
+    mask; all arrays are [nmonth,nlev,nlat] except 'volume' [nlev,nlat].
+
+    """
+    mass = np.ma.getdata(rho_zm)*volume
+    oz_redist = np.ma.getdata(oz_redist)
+    # Both integrals have always started from 1 rather than 0
+    glob_dt = 1. - np.einsum('mij,mij->m', oz_redist - np.ma.getdata(oz_zm),
+                             mass)
+    strat_oz2d = 1. + np.einsum('mij,mij->m',
+                                np.where(stratosphere, oz_redist, 0.), mass)
+    return (strat_oz2d + glob_dt) / strat_oz2d
@@ -15,9 +15,22 @@ use the following:
 
 Note that a netCDF will be created alongside the ancillary.
 
+To regenerate several years in one run, replace -y with --years FIRST LAST and
+put '{year}' in the output (and, if they differ by year, the tropopause and
+density) file names; --processes sets how many years are processed at once.
+
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import resource
+import time
+import zipfile
+
 import numpy as np
 
 import ants
@@ -25,6 +38,18 @@ import iris
 import iris.analysis.cartography
 import iris.coord_categorisation as coord_cat
 
+from ozone_kernels import (cell_volume, centred_difference,
+                           redistribute_columns, stratospheric_scaling)
+import vertical_levels
+
+# Version of the quantities stored by GeometryCache
+GEOMETRY_CACHE_VERSION = 1
+
+# Stage timings are written to the output file name plus TIMINGS_SUFFIX when
+# --timings is given or TIMINGS_ENV is set to true
+TIMINGS_SUFFIX = '.timings.json'
+TIMINGS_ENV = 'REDISTRIBUTE_OZONE_TIMINGS'
+
 
 def get_dim(cube, name):
     """Get the dimension on the 'cube' of the coordinate named 'name'."""
@@ -39,7 +64,7 @@ def get_dim(cube, name):
     return dim[0]
 
 
-def fix_fields(cube):
+def fix_fields(cube, lazy=False):
     """
     Tweak cube derived from fields file to be compatible with one from a pp.
 
@@ -48,8 +73,14 @@ def fix_fields(cube):
     promotes it to an axis to allow concatenation with multiple time pp
     fields).
 
+    With 'lazy', the conversion to float32 is deferred so that it is done chunk
+    by chunk when the data are eventually realised.
+
     """
-    cube.data = np.array(cube.data, dtype=np.float32)
+    if lazy:
+        cube.data = cube.lazy_data().astype(np.float32)
+    else:
+        cube.data = np.array(cube.data, dtype=np.float32)
     cube = iris.util.new_axis(cube, 'time')
     return cube
 
@@ -77,7 +108,7 @@ def remove_extra_time_coords(cube):
             pass
 
 
-def load_data(data, constraint):
+def load_data(data, constraint, lazy=False):
     """
     Load data files, and fix some common problems.
 
@@ -85,6 +116,8 @@ def load_data(data, constraint):
     files consistent with the pp files, and finally concatenate into a single
     cube.
 
+    With 'lazy', the data are left unrealised (see fix_fields).
+
     """
     cubes = iris.load(data, constraint)
 
@@ -96,7 +129,7 @@ def load_data(data, constraint):
     pp_files = cubes.extract(pp_constraint)
     nc_files = cubes.extract(nc_constraint)
 
-    fields_files = [fix_fields(ff) for ff in fields_files]
+    fields_files = [fix_fields(ff, lazy=lazy) for ff in fields_files]
     cubes = iris.cube.CubeList(fields_files)
 
     pp_files = [fix_pp(pp) for pp in pp_files]
@@ -161,17 +194,267 @@ def reconcile_lat_lon(cube1, cube2):
     cube2.coord('longitude').circular = cube1.coord('longitude').circular
 
 
-def process(args):
+def interpolate_by_time(cube, sample_points, scheme):
+    """
+    Interpolate 'cube' one time at a time.
+
+    Equivalent to cube.interpolate(sample_points, scheme), but for a lazy cube
+    only a single time of the source data is realised at once.
+
+    """
+    time_dim = get_dim(cube, 'time')
+    index = [slice(None)] * cube.ndim
+    cubes = iris.cube.CubeList()
+    for i in range(cube.shape[time_dim]):
+        index[time_dim] = slice(i, i+1)
+        cubes.append(cube[tuple(index)].interpolate(sample_points, scheme))
+    return cubes.concatenate_cube()
+
+
+def apply_zonal_increment(cube, increment):
+    """
+    Add the zonal mean 'increment' to every longitude of 'cube' in place.
+
+    The cube data are realised once as float32 (lazy data are converted chunk
+    by chunk, so there is never a float64 copy of the whole field) and the
+    increment is broadcast along longitude in a single in-place addition.
+
+    """
+    lon_dim = get_dim(cube, 'longitude')
+    if lon_dim != cube.ndim - 1:
+        msg = 'Expected longitude to be the last dimension of {}, got {}'
+        raise ValueError(msg.format(cube.name(), lon_dim))
+    cube.data = cube.core_data().astype(np.float32, copy=False)
+    data = np.ma.getdata(cube.data)
+    np.add(data, np.ma.getdata(increment)[..., np.newaxis], out=data,
+           casting='unsafe')
+
+
+class GeometryCache(object):
+    """
+    On-disk cache of resolution dependent grid geometry.
+
+    Each entry is an .npz file in 'directory' named after a hash of the
+    arrays it is derived from and of GEOMETRY_CACHE_VERSION.  A change to any
+    of those inputs gives a different name, so stale entries are never used;
+    bump GEOMETRY_CACHE_VERSION whenever the way the cached quantities are
+    calculated changes.  Unreadable entries are recalculated and rewritten.
+
+    If 'directory' is None nothing is cached and everything is calculated.
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, name, arrays):
+        """Hash identifying the entry 'name' derived from 'arrays'."""
+        digest = hashlib.sha1()
+        digest.update('{}:{}'.format(name, GEOMETRY_CACHE_VERSION).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(np.ma.getdata(array))
+            digest.update('{}{}'.format(array.dtype.str, array.shape).encode())
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def load_or_compute(self, name, arrays, compute):
+        """
+        Get the dictionary of arrays 'name' derived from 'arrays'.
+
+        It is read from the cache if possible, otherwise 'compute' is called
+        to calculate it and the result is stored in the cache.
+
+        """
+        if self.directory is None:
+            return compute()
+        path = os.path.join(self.directory, '{}-{}.npz'.format(
+            name, self.key(name, arrays)))
+        try:
+            with np.load(path) as cached:
+                result = {k: cached[k] for k in cached.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            pass
+        else:
+            self.hits += 1
+            print('Grid geometry cache hit: {}'.format(path))
+            return result
+        self.misses += 1
+        print('Grid geometry cache miss: {}'.format(path))
+        result = compute()
+        # Write to a temporary file first so that concurrent runs never see
+        # a partial entry
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **result)
+        os.replace(tmp_path, path)
+        return result
+
+    def area_weights(self, cube):
+        """Cached iris.analysis.cartography.area_weights for 'cube'."""
+        lat_dim = get_dim(cube, 'latitude')
+        lon_dim = get_dim(cube, 'longitude')
+        if (lat_dim, lon_dim) != (cube.ndim - 2, cube.ndim - 1):
+            return iris.analysis.cartography.area_weights(cube)
+        lat = cube.coord('latitude')
+        lon = cube.coord('longitude')
+
+        def compute():
+            weights = iris.analysis.cartography.area_weights(cube)
+            return {'area': weights[(0,) * (cube.ndim - 2)]}
+
+        key_arrays = [lat.bounds, lon.bounds,
+                      np.frombuffer(repr(cube.coord_system()).encode(),
+                                    dtype=np.uint8)]
+        area = self.load_or_compute('area', key_arrays, compute)['area']
+        return np.broadcast_to(area, cube.shape)
+
+    def report(self):
+        """Print the number of cache hits and misses."""
+        print('Grid geometry cache: {} hits, {} misses'.format(
+            self.hits, self.misses))
+
+
+def grid_geometry(oz, orog):
+    """
+    Resolution dependent quantities used to redistribute the ozone 'oz'.
+
+    Returns a dictionary with cos(latitude) 'coslat', the latitude and
+    longitude spacings 'dlat' and 'dlon' (radians) and the zonal means of the
+    altitude 'hz' and thickness 'dz2d' (m) of the ozone levels [nlev,nlat],
+    calculated from the hybrid height coordinates of 'oz' and orography
+    'orog'.
+
+    """
+    oz_withheight = oz.copy()
+
+    orog_coord = iris.coords.AuxCoord(
+        points=orog.data, units="m", standard_name="surface_altitude")
+
+    lat_dim = get_dim(oz_withheight, 'latitude')
+    lon_dim = get_dim(oz_withheight, 'longitude')
+    oz_withheight.add_aux_coord(orog_coord, (lat_dim, lon_dim))
+
+    factory = iris.aux_factory.HybridHeightFactory(
+        delta=oz_withheight.coord("level_height"),
+        sigma=oz_withheight.coord("sigma"),
+        orography=oz_withheight.coord("surface_altitude"))
+
+    oz_withheight.add_aux_factory(factory)
+
+    hz = oz_withheight.coord("altitude").points
+
+    longitude = oz.coord('longitude').points  # [nlon]
+    latitude = oz.coord('latitude').points  # [nlat]
+    dz = centred_difference(hz, axis=0)  # m [nlev,nlat,nlon]
+
+    return {
+        'coslat': np.cos(latitude*np.pi/180.),
+        'dlon': (np.pi/180.)*centred_difference(longitude),
+        'dlat': (np.pi/180.)*centred_difference(latitude),
+        'dz2d': np.average(dz, axis=2),
+        'hz': np.average(hz, axis=2),
+    }
+
+
+def load_ozone(args, ozone=None):
+    """
+    Load the ozone for args.year from the file args.ozone.
+
+    If 'ozone' is given, it is the cube already loaded from args.ozone and the
+    year is extracted from it rather than reading the file again.  The cube
+    returned is always a copy, since it is modified in place for each year.
+
+    """
+    ozone_constraint = iris.Constraint(
+        time=lambda cell: cell.point.year == args.year)
+    try:
+        if ozone is None:
+            oz = iris.load_cube(args.ozone, ozone_constraint)
+        else:
+            oz = ozone.extract(ozone_constraint)
+            if oz is None:
+                raise iris.exceptions.ConstraintMismatchError(
+                    'No ozone for year {}'.format(args.year))
+            if oz is ozone:
+                # extract returns the cube itself when every time matches
+                oz = oz.copy()
+    except iris.exceptions.ConstraintMismatchError:
+        if args.strict_year:
+            raise
+        else:
+            # Single year ozone file doesn't fit constraint since it's missing the
+            # year from the time coordinate:
+            if ozone is None:
+                oz = iris.load_cube(args.ozone)
+            else:
+                oz = ozone.copy()
+            # But still worth checking it really is a single year
+            if len(oz.coord(axis='t').points) != 12:
+                raise RuntimeError(
+                    "Ozone file {} doesn't have expected time coordinates"
+                    .format(args.ozone))
+    return oz
+
+
+def load_inputs(args, orog=None, ozone=None):
+    """
+    Load the tropopause, density, ozone and orography for args.year.
+
+    The orography and the cube loaded from the whole ozone file can be passed
+    in as 'orog' and 'ozone' when they have already been loaded; otherwise
+    they are read from args.orography and args.ozone.
+
+    Returns the cubes (th, rhoa2, oz, orog).  The density and ozone must be
+    on the vertical level set args.levels.
+
+    """
     # READ IN dyn tropopause and orography **from MASS**
     # Want last 2 years worth of monthly mean data
     # **Will also read density from MASS, and oz from ancillary**
 
-    th = load_data(args.tropopause, 'tropopause_altitude')
+    th = load_data(args.tropopause, 'tropopause_altitude', lazy=args.lazy)
     # th = iris.load_cube('/data/local/hadvh/cmip6/bb582/*.pp',
     #                    iris.Constraint('tropopause_altitude'))  # [24,nlat,nlon]
     # **Orog is resolution dependent file** [nlat,nlon]
-    orog = iris.load_cube(args.orography, 'surface_altitude')
+    if orog is None:
+        orog = iris.load_cube(args.orography, 'surface_altitude')
+
+    # READ IN ozone and pressure(or density)
+
+    # Density*r*r (STASH 253):  **Need to add STASH 253 to CMIP6 jobs**
+
+    # [24,nlev,nlat,nlon]
+    rhoa2 = load_data(args.density,
+                      iris.AttributeConstraint(STASH='m01s00i253'),
+                      lazy=args.lazy)
+    # ** oz should be ancillary created for previous year (except in yr1 of run) **
+    oz = load_ozone(args, ozone)  # [12,nlev,nlat,nlon]
+
+    levels = vertical_levels.level_set(args.levels)
+    for name, cube in (('density', rhoa2), ('ozone', oz)):
+        vertical_levels.check_levels(levels, cube.shape[1], name)
+
+    if oz.coord('latitude').bounds is None:
+        oz.coord('latitude').guess_bounds()
+
+    if oz.coord('longitude').bounds is None:
+        oz.coord('longitude').guess_bounds()
+
+    return th, rhoa2, oz, orog
+
+
+def form_climatologies(th, rhoa2, orog, cache):
+    """
+    Form the monthly climatologies of the tropopause and density.
+
+    Returns the zonal mean tropopause altitude above sea level [12,nlat] and
+    the density climatology [12,nlev,nlat,nlon].
 
+    """
     # Form monthly climatologies
 
     coord_cat.add_month(th, 'time', name='month')
@@ -190,53 +473,38 @@ def process(args):
     if th.coord('longitude').bounds is None:
         th.coord('longitude').guess_bounds()
 
-    grid_areas = iris.analysis.cartography.area_weights(th)
+    grid_areas = cache.area_weights(th)
 
     # Form zonal mean
 
     th = th.collapsed(['longitude'],
                       iris.analysis.MEAN, weights=grid_areas)  # [12,nlat]
 
-    # READ IN ozone and pressure(or density)
-
-    # Density*r*r (STASH 253):  **Need to add STASH 253 to CMIP6 jobs**
-
-    # [24,85,nlat,nlon]
-    rhoa2 = load_data(args.density,
-                      iris.AttributeConstraint(STASH='m01s00i253'))
     coord_cat.add_month(rhoa2, 'time', name='month')
-    rhoa2 = rhoa2.aggregated_by(['month'], iris.analysis.MEAN)  # [12,85,nlat,nlon]
-    # ** oz should be ancillary created for previous year (except in yr1 of run) **
-    ozone_constraint = iris.Constraint(
-        time=lambda cell: cell.point.year == args.year)
-    try:
-        oz = iris.load_cube(args.ozone, ozone_constraint)
-    except iris.exceptions.ConstraintMismatchError:
-        if args.strict_year:
-            raise
-        else:
-            # Single year ozone file doesn't fit constraint since it's missing the
-            # year from the time coordinate:
-            oz = iris.load_cube(args.ozone)
-            # But still worth checking it really is a single year
-            if len(oz.coord(axis='t').points) != 12:
-                raise RuntimeError(
-                    "Ozone file {} doesn't have expected time coordinates"
-                    .format(args.ozone))
-    # [12,85,nlat,nlon]
+    rhoa2 = rhoa2.aggregated_by(['month'], iris.analysis.MEAN)  # [12,nlev,nlat,nlon]
 
-    if oz.coord('latitude').bounds is None:
-        oz.coord('latitude').guess_bounds()
+    return th, rhoa2
 
-    if oz.coord('longitude').bounds is None:
-        oz.coord('longitude').guess_bounds()
 
-    # Vertically interpolate rhoa2 onto ozone grid
+def interpolate_density(rhoa2, oz, lazy=False):
+    """
+    Vertically interpolate the density climatology onto the ozone levels.
+
+    The result has the same time and vertical coordinates as 'oz'.
 
+    """
     alt = oz.coord('level_height').points
     # rhoa2_interp = rhoa2.interpolate([('level_height', alt)],
-    rhoa2_interp = rhoa2.interpolate([('atmosphere_hybrid_height_coordinate', alt)],
-                                     iris.analysis.Linear())
+    if lazy:
+        # The climatology is still lazy, so interpolate a month at a time to
+        # bound the memory used
+        rhoa2_interp = interpolate_by_time(
+            rhoa2, [('atmosphere_hybrid_height_coordinate', alt)],
+            iris.analysis.Linear())
+    else:
+        rhoa2_interp = rhoa2.interpolate(
+            [('atmosphere_hybrid_height_coordinate', alt)],
+            iris.analysis.Linear())
     rhoa2 = rhoa2_interp.copy()
 
     # Make rhoa2 and oz meta-data the same
@@ -277,6 +545,17 @@ def process(args):
         pass
     rhoa2.add_dim_coord(model_level_number, vertical_dim)
 
+    return rhoa2
+
+
+def redistribute(oz, rhoa2, th, orog, cache):
+    """
+    Redistribute the mass weighted zonal mean ozone about the tropopause.
+
+    Returns the redistributed and original zonal mean ozone and the zonal
+    mean density [12,nlev,nlat], and the grid geometry (see grid_geometry).
+
+    """
     # Form mass weighted zonal mean -- int(oz*p)/int(p)
 
     if rhoa2.coord('latitude').bounds is None:
@@ -285,7 +564,7 @@ def process(args):
     if rhoa2.coord('longitude').bounds is None:
         rhoa2.coord('longitude').guess_bounds()
 
-    grid_areas = iris.analysis.cartography.area_weights(rhoa2)
+    grid_areas = cache.area_weights(rhoa2)
 
     # If density has an orography, remove it - we want to be working with
     # level heights:
@@ -307,159 +586,186 @@ def process(args):
                                iris.analysis.MEAN, weights=grid_areas)
     oz2d = iris.analysis.maths.divide(oz2d, rhoa2_2d)
 
-    # Calculate actual height(x,y,z) corresp to ozone hybrid_ht
+    # Calculate actual height(x,y,z) corresp to ozone hybrid_ht, and the
+    # other resolution dependent quantities for the REDISTRIBUTION
 
-    oz_withheight = oz.copy()
+    geometry = cache.load_or_compute(
+        'geometry',
+        [orog.data, oz.coord('level_height').points, oz.coord('sigma').points,
+         oz.coord('latitude').points, oz.coord('longitude').points],
+        lambda: grid_geometry(oz, orog))
 
-    orog_coord = iris.coords.AuxCoord(
-        points=orog.data, units="m", standard_name="surface_altitude")
+    # REMOVE tropospheric ozone = dT ...
 
-    lat_dim = get_dim(oz_withheight, 'latitude')
-    lon_dim = get_dim(oz_withheight, 'longitude')
-    oz_withheight.add_aux_coord(orog_coord, (lat_dim, lon_dim))
+    oz2d_dat = oz2d.data
+    oz_redist = redistribute_columns(oz2d_dat, geometry['hz'], th.data)
 
-    factory = iris.aux_factory.HybridHeightFactory(
-        delta=oz_withheight.coord("level_height"),
-        sigma=oz_withheight.coord("sigma"),
-        orography=oz_withheight.coord("surface_altitude"))
+    return oz_redist, oz2d_dat, rhoa2_2d.data, geometry
 
-    oz_withheight.add_aux_factory(factory)
 
-    hz = oz_withheight.coord("altitude").points
+def conserve_mass(oz_redist, oz2d_dat, rho2d_dat, th_dat, geometry):
+    """
+    Rescale the redistributed stratospheric ozone to conserve ozone mass.
 
-    # REDISTRIBUTION
+    'oz_redist' is modified in place.
 
-    longitude = oz.coord('longitude').points  # [nlon]
-    latitude = oz.coord('latitude').points  # [nlat]
-    nlon = np.size(longitude)
-    nlat = np.size(latitude)
-    coslat = np.cos(latitude*np.pi/180.)
-    dlon = np.ones(nlon)
-    dlat = np.ones(nlat)
-    dz = np.ones([85, nlat, nlon])  # m
-
-    for i in np.arange(1, nlon-1):
-        dlon[i] = (longitude[i+1] - longitude[i-1])/2.
-    dlon[0] = longitude[1] - longitude[0]
-    dlon[nlon-1] = longitude[nlon-1] - longitude[nlon-2]
-
-    for i in np.arange(1, nlat-1):
-        dlat[i] = (latitude[i+1] - latitude[i-1])/2.
-    dlat[0] = latitude[1] - latitude[0]
-    dlat[nlat-1] = latitude[nlat-1] - latitude[nlat-2]
-
-    dlon = (np.pi/180.)*dlon
-    dlat = (np.pi/180.)*dlat
-
-    for j in np.arange(nlat):
-        for k in np.arange(nlon):
-            for i in np.arange(1, 84):
-                dz[i, j, k] = (hz[i+1, j, k] - hz[i-1, j, k])/2.
-            dz[0, j, k] = hz[1, j, k] - hz[0, j, k]
-            dz[84, j, k] = hz[84, j, k] - hz[83, j, k]
+    """
+    # Calculate mass of ozone removed (dT) and of stratospheric ozone (S)
 
-    # REMOVE tropospheric ozone = dT ...
-
-    dz2d = np.average(dz, axis=2)
-    hz = np.average(hz, axis=2)  # [85,nlat]
-    oz2d_dat = oz2d.data
-    oz_redist = oz2d_dat.copy()
-
-    th_dat = th.data
-    for l in np.arange(12):
-        for j in np.arange(nlat):
-            # Define height of ozone tropopause (for each lat)
-            # = 1km below dynamical tropopause
-            counter_dyntrop = np.where(hz[:, j] > (th_dat[l, j] - 1000.))[0]
-            counter_dyntrop = counter_dyntrop[0]
-            # Set ozone to 80ppbv at ozone tropopause.
-            # Linearly interpolate to value 2km above dynamical tropopause.
-            oz_redist[l, counter_dyntrop, j] = 1.32e-7  # 80ppbv
-            counter_highoz = np.where(hz[:, j] > (th_dat[l, j] + 2000.))[0]
-            counter_highoz = 1+counter_highoz[0]
-            # linearly interpolate log(ozone)
-            # in height between highoz values and 80ppbv
-            ozint = [np.log(oz_redist[l, counter_dyntrop, j]),
-                     np.log(oz2d_dat[l, counter_highoz, j])]
-            htint = [hz[counter_dyntrop, j], hz[counter_highoz, j]]
-            htsint = hz[counter_dyntrop:counter_highoz, j]
-            oz_redist[l, counter_dyntrop:counter_highoz, j] = np.exp(
-                np.interp(htsint, htint, ozint))
-            # If orig ozone is < 80ppbv at 1km below, then set at 80ppbv
-            # and linearly interpolate down to value 2km below this
-            if (oz2d_dat[l, counter_dyntrop, j] < 1.32e-7):
-                counter_lowoz = np.where(hz[:, j] > (th_dat[l, j] - 3000.))[0]
-                counter_lowoz = counter_lowoz[0]
-                # linearly interpolate log(ozone) in height
-                # between lowoz values and 80ppbv
-                ozint = [np.log(oz2d_dat[l, counter_lowoz, j]),
-                         np.log(oz_redist[l, counter_dyntrop, j])]
-                htint = [hz[counter_lowoz, j], hz[counter_dyntrop, j]]
-                htsint = hz[counter_lowoz:counter_dyntrop, j]
-                oz_redist[l, counter_lowoz:counter_dyntrop, j] = np.exp(
-                    np.interp(htsint, htint, ozint))
-            # If orig ozone is > 80ppbv at 1km below, then keep at 80ppbv
-            # until height where it becomes 80ppbv
-            if (oz2d_dat[l, counter_dyntrop, j] > 1.32e-7):
-                counter_oztrop = np.where(oz2d_dat[l, :, j] < 1.32e-7)[0]
-                counter_oztrop = counter_oztrop[np.size(counter_oztrop)-1]
-                oz_redist[l, counter_oztrop+1:counter_dyntrop, j] = 1.32e-7
-
-    # Calculate mass of ozone removed (dT)
-
-    glob_dt = np.ones([12])
-    oz2d_diff = oz2d.copy()
-    oz2d_diff.data = oz_redist - oz2d_dat
-    oz2d_diff = iris.analysis.maths.multiply(oz2d_diff, rhoa2_2d)
-    oz2d_diff_dat = oz2d_diff.data
-    for l in np.arange(12):
-        for i in np.arange(85):
-            for j in np.arange(nlat):
-                glob_dt[l] = glob_dt[l] - \
-                    oz2d_diff_dat[l, i, j]*coslat[j]*2.*np.pi*dlat[j]*dz2d[i, j]
-
-    # Calculate mass of stratospheric ozone (S)
-
-    strat_oz2d = np.ones([12])
-    oz2d_diff = oz2d.copy()
-    oz2d_diff.data = oz_redist
-    oz2d_diff = iris.analysis.maths.multiply(oz2d_diff, rhoa2_2d)
-    oz2d_diff_dat = oz2d_diff.data
-    for l in np.arange(12):
-        for j in np.arange(nlat):
-            counter = np.where(hz[:, j] > th_dat[l, j])[0]
-            counter = counter[0]
-            for i in np.arange(counter, 85):
-                strat_oz2d[l] = strat_oz2d[l] + \
-                    oz2d_diff_dat[l, i, j]*coslat[j]*2.*np.pi*dlat[j]*dz2d[i, j]
+    hz = geometry['hz']  # [nlev,nlat]
+    volume = cell_volume(geometry['coslat'], geometry['dlat'],
+                         geometry['dz2d'])  # [nlev,nlat]
+    stratosphere = hz[np.newaxis, :, :] > th_dat[:, np.newaxis, :]
+    strat_oz2d = stratospheric_scaling(
+        oz_redist, oz2d_dat, rho2d_dat, volume, stratosphere)
 
     # Multiply stratospheric ozone by (S+dT)/S
 
-    strat_oz2d = (strat_oz2d + glob_dt) / strat_oz2d
+    scaling = np.broadcast_to(strat_oz2d[:, np.newaxis, np.newaxis],
+                              oz_redist.shape)
+    oz_redist[stratosphere] = oz_redist[stratosphere]*scaling[stratosphere]
 
-    for j in np.arange(nlat):
-        counter = np.where(hz[:, j] > th_dat[l, j])[0]
-        counter = counter[0]
-        for i in np.arange(counter, 85):
-            oz_redist[:, i, j] = oz_redist[:, i, j]*strat_oz2d
 
+def save_ozone(oz, oz_diff, output):
+    """Apply the zonal mean increment 'oz_diff' to 'oz' and save it."""
     # Apply redistribution to 3D ozone field
 
-    oz_diff = oz_redist - oz2d_dat
-
-    for k in np.arange(nlon):
-        oz.data[:, :, :, k] = oz.data[:, :, :, k] + oz_diff
+    apply_zonal_increment(oz, oz_diff)
 
-    oz.data = oz.data
     # ** Write oz to new ancillary **
     if oz.coord('time').bounds is None:
         oz.coord('time').guess_bounds()
-    ants.save(oz, args.output, saver='ancil')
+    ants.save(oz, output, saver='ancil')
 
     # ** Transfer this ancillary to HPC **
     # ** Store this ancillary on MASS **
 
 
+class StageTimer(object):
+    """
+    Wall time, CPU time and RSS high-water mark of named processing stages.
+
+    Where the kernel allows it (/proc/self/clear_refs), the RSS high-water
+    mark is reset at the start of each stage so that it covers that stage
+    only; otherwise it is the high-water mark of the process so far, which
+    is recorded as 'rss_reset': false.  A disabled timer records nothing.
+
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+
+    @staticmethod
+    def reset_peak_rss():
+        """Reset the RSS high-water mark, returning whether that worked."""
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def peak_rss():
+        """RSS high-water mark of this process (bytes)."""
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager recording the stage 'name'."""
+        if not self.enabled:
+            yield
+            return
+        rss_reset = self.reset_peak_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        yield
+        self.stages.append({
+            'stage': name,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'peak_rss': self.peak_rss(),
+            'rss_reset': rss_reset,
+        })
+
+    def report(self):
+        """Print the recorded stages."""
+        for stage in self.stages:
+            print('{stage}: wall {wall:.2f}s, cpu {cpu:.2f}s, '
+                  'peak RSS {rss:.1f} MiB'.format(
+                      rss=stage['peak_rss'] / 2.**20, **stage))
+
+    def write(self, filename, **metadata):
+        """Write the recorded stages, and any 'metadata', as JSON."""
+        report = dict(metadata)
+        report['stages'] = self.stages
+        report['total'] = {
+            'wall': sum(stage['wall'] for stage in self.stages),
+            'cpu': sum(stage['cpu'] for stage in self.stages),
+            'peak_rss': max([stage['peak_rss'] for stage in self.stages],
+                            default=0),
+        }
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def timings_enabled(args):
+    """Whether to write stage timings, from --timings or the environment."""
+    return (args.timings or
+            os.environ.get(TIMINGS_ENV, '').lower() in ('true', '1'))
+
+
+def process(args, orog=None, ozone=None, timer=None):
+    """
+    Redistribute the ozone for a single year, args.year.
+
+    The orography and the cube loaded from the whole ozone file can be passed
+    in as 'orog' and 'ozone' when they have already been loaded; otherwise
+    they are read from args.orography and args.ozone.
+
+    Each stage is recorded by 'timer' (a StageTimer).  If it isn't given, a
+    timer is created when timings are enabled (see timings_enabled) and its
+    report written to a JSON file next to the output.
+
+    """
+    write_timings = timer is None and timings_enabled(args)
+    if timer is None:
+        timer = StageTimer(enabled=write_timings)
+    cache = GeometryCache(args.geometry_cache)
+
+    with timer.stage('load'):
+        th, rhoa2, oz, orog = load_inputs(args, orog, ozone)
+    with timer.stage('climatology'):
+        th, rhoa2 = form_climatologies(th, rhoa2, orog, cache)
+    with timer.stage('interpolation'):
+        rhoa2 = interpolate_density(rhoa2, oz, lazy=args.lazy)
+    with timer.stage('redistribution'):
+        oz_redist, oz2d_dat, rho2d_dat, geometry = redistribute(
+            oz, rhoa2, th, orog, cache)
+    with timer.stage('mass_budget'):
+        conserve_mass(oz_redist, oz2d_dat, rho2d_dat, th.data, geometry)
+    with timer.stage('save'):
+        save_ozone(oz, oz_redist - oz2d_dat, args.output)
+
+    if args.geometry_cache:
+        cache.report()
+    if write_timings:
+        timer.report()
+        timer.write(args.output + TIMINGS_SUFFIX, output=args.output,
+                    year=args.year, lazy=args.lazy,
+                    geometry_cache_hits=cache.hits,
+                    geometry_cache_misses=cache.misses)
+
+
 def get_arg_parser(docs=None):
     """CLI argument parser for input and output files."""
     parser = argparse.ArgumentParser(
@@ -511,14 +817,25 @@ def get_arg_parser(docs=None):
         help="File name for ozone file",
     )
 
-    required.add_argument(
+    years = required.add_mutually_exclusive_group(required=True)
+
+    years.add_argument(
         '-y',
         '--year',
-        required=True,
         type=int,
         help="Year to use from the ozone file",
     )
 
+    years.add_argument(
+        '--years',
+        nargs=2,
+        type=int,
+        metavar=('FIRST', 'LAST'),
+        help="Range of years (inclusive) to process in one batch.  Any "
+             "'{year}' in the output, tropopause and density file names is "
+             "replaced by each year in turn",
+    )
+
     parser.add_argument(
         '--strict_year',
         dest='strict_year',
@@ -526,10 +843,116 @@ def get_arg_parser(docs=None):
         help='Enforce strict checking of year constraint'
     )
 
+    parser.add_argument(
+        '--lazy',
+        dest='lazy',
+        action='store_true',
+        help='Keep tropopause and density data lazy, so the float32 '
+             'conversion, monthly climatology and vertical interpolation '
+             'are done chunk by chunk to reduce peak memory'
+    )
+
+    parser.add_argument(
+        '--timings',
+        dest='timings',
+        action='store_true',
+        help='Write the wall time, CPU time and peak memory of each stage to '
+             'a JSON file next to the output (also enabled by setting '
+             '{}=true)'.format(TIMINGS_ENV)
+    )
+
+    parser.add_argument(
+        '--processes',
+        dest='processes',
+        type=int,
+        default=1,
+        help='Number of worker processes for --years'
+    )
+
+    parser.add_argument(
+        '--geometry_cache',
+        dest='geometry_cache',
+        type=str,
+        default=None,
+        help='Directory in which to cache grid geometry between runs on the '
+             'same grid'
+    )
+
+    parser.add_argument(
+        '--levels',
+        dest='levels',
+        type=str,
+        default=vertical_levels.DEFAULT_LEVELS,
+        help='Vertical level set of the density and ozone, one of {} or an '
+             '.npz file (default %(default)s)'.format(
+                 ', '.join(vertical_levels.available_level_sets()))
+    )
+
     return parser
 
 
+def year_arguments(args, year):
+    """Copy of 'args' for processing 'year', with '{year}' filled in."""
+    year_args = argparse.Namespace(**vars(args))
+    year_args.year = year
+    year_args.years = None
+    year_args.output = args.output.replace('{year}', str(year))
+    year_args.tropopause = [f.replace('{year}', str(year))
+                            for f in args.tropopause]
+    year_args.density = [f.replace('{year}', str(year)) for f in args.density]
+    return year_args
+
+
+# Inputs shared by all years in batch mode, set in each worker process
+shared_inputs = {}
+
+
+def set_shared_inputs(orog, ozone):
+    """Worker initialiser for process_years."""
+    shared_inputs['orog'] = orog
+    shared_inputs['ozone'] = ozone
+
+
+def process_year(args):
+    """Worker for process_years."""
+    process(args, **shared_inputs)
+    return args.output
+
+
+def process_years(args):
+    """
+    Redistribute the ozone for every year in the range args.years.
+
+    The orography and ozone files are loaded once and each year is then
+    processed exactly as a single year run would, in a pool of
+    args.processes worker processes.
+
+    """
+    first, last = args.years
+    if last > first and '{year}' not in args.output:
+        raise ValueError("Output {} must contain '{{year}}' to process more "
+                         "than one year".format(args.output))
+    orog = iris.load_cube(args.orography, 'surface_altitude')
+    ozone = iris.load_cube(args.ozone)
+    year_args = [year_arguments(args, year) for year in range(first, last+1)]
+    if args.processes == 1:
+        set_shared_inputs(orog, ozone)
+        outputs = map(process_year, year_args)
+        for year, output in zip(range(first, last+1), outputs):
+            print('Year {} written to {}'.format(year, output))
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.processes, initializer=set_shared_inputs,
+            initargs=(orog, ozone)) as executor:
+        outputs = executor.map(process_year, year_args)
+        for year, output in zip(range(first, last+1), outputs):
+            print('Year {} written to {}'.format(year, output))
+
+
 if __name__ == '__main__':
     arg_parser = get_arg_parser(__doc__)
     args = arg_parser.parse_args()
-    process(args)
+    if args.years:
+        process_years(args)
+    else:
+        process(args)
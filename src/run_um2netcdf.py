@@ -3,124 +3,521 @@
 # Run the netcdf conversion. Assumes monthly files using names set as
 # filename_base='$DATAM/${RUNID}a.pa%C'
 # Runs in the archive directory
+#
+# The files are independent, so they are converted by a pool of
+# NETCDF_WORKERS processes (default 1, one after another), largest first.
+# NETCDF_WORKER_MEMORY limits the address space of each worker, in GB. When it
+# is set the conversions run in a worker process even with one worker.
+# Failures are reported once all the files have been tried, and the script
+# then exits non-zero.
+#
+# With USE_JOBFS the inputs are copied to $PBS_JOBFS, JOBFS_PREFETCH files
+# (default 2) ahead of the conversions, and the outputs moved back in the
+# background. JOBFS_STAGING_GB bounds the space used there (default 90% of
+# the free space).
+#
+# Each conversion is recorded in netCDF/manifest.json, with the size and
+# modification time of its input and the status of its output. With USE_JOBFS
+# the checksum of the input, computed as it is copied, is recorded too, so an
+# input whose modification time changed but whose contents didn't isn't
+# converted again.
+# A rerun skips the outputs already completed from the same inputs (also when
+# REMOVE_FF has since removed the input) and redoes any left incomplete. With
+# --resume the completed outputs are trusted without checking their inputs.
+#
+# The reinitialisation period of each output stream in ATMOSCNTL is cached in
+# netCDF/stream_plan.json, so the namelist is only parsed again when it
+# changes.
 
-import os, datetime, collections, um2netcdf4, shutil, re, f90nml
+import os, sys, datetime, collections, um2netcdf4, shutil, re, f90nml, resource
+import argparse, concurrent.futures, functools, hashlib, json, threading, traceback
 from pathlib import Path
 from dateutil import rrule
 from collections.abc import Sequence
 
-CYLC_TASK_CYCLE_POINT = os.environ['CYLC_TASK_CYCLE_POINT']
-NEXT_CYCLE = os.environ['NEXT_CYCLE']
-RUNID = os.environ['RUNID']
-STREAMS = os.environ['NETCDF_STREAMS']
-try:
-    ARCHIVEDIR = os.environ['ARCHIVEDIR']
-    arch = True
-except:
-    DATAM = os.environ['DATAM']
-    arch = False
-print("archive (history/atm): ", arch)
-REMOVE_FF = os.environ['REMOVE_FF'].lower() == 'true'
-print("REMOVE_FF", REMOVE_FF)
-try:
-    USE_JOBFS = os.environ['USE_JOBFS'].lower() == 'true'
-except KeyError:
-    USE_JOBFS = False
-if USE_JOBFS:
-    PBS_JOBFS = os.environ['PBS_JOBFS']
-
-# This should get the stream names from the model setup, filename_base
-prefix = RUNID+'a.p'
-# Strip off time zone (if present) and uses the YYYYMMDD part
-start_date = datetime.datetime.strptime(CYLC_TASK_CYCLE_POINT[:8], '%Y%m%d')
-next_date = datetime.datetime.strptime(NEXT_CYCLE[:8], '%Y%m%d')
-end_date = next_date - datetime.timedelta(seconds=1)
-
-# Get the reinitialisation unit and frequency from the UM namelist
-ATM_RUNDIR=os.environ['ATM_RUNDIR']
-nml = f90nml.read(Path(ATM_RUNDIR)/'ATMOSCNTL')
-stream_unit = {}
-stream_step = {}
-# Not a list if there's only a single item
-if isinstance(nml['nlstcall_pp'], Sequence):
-    iterator = nml['nlstcall_pp']
-else:
-    iterator = [nml['nlstcall_pp']]
-for n in iterator:
-    basename = Path(n['filename_base']).name
+# Named tuple to hold the argument list
+Args = collections.namedtuple('Args', 'nckind compression simple nomask hcrit verbose include_list exclude_list nohist use64bit')
+ARGS = Args(3, 4, True, False, 0.5, False, None, None, False, False)
+
+# One conversion; input and output are Paths
+Job = collections.namedtuple('Job', 'stream date input output')
+
+# UM reinit_unit values supported. 10-day streams are daily with reinit_step 10
+REINIT_UNITS = {1: rrule.HOURLY, 2: rrule.DAILY, 4: rrule.MONTHLY}
+
+MANIFEST_NAME = 'manifest.json'
+PLAN_NAME = 'stream_plan.json'
+PLAN_VERSION = 2
+CHECKSUM_BLOCK = 2**20
+
+def get_streams(nml, runid):
+    """Reinitialisation unit and step of each stream in the UM namelist"""
+    stream_unit = {}
+    stream_step = {}
+    # Not a list if there's only a single item
+    if isinstance(nml['nlstcall_pp'], Sequence):
+        iterator = nml['nlstcall_pp']
+    else:
+        iterator = [nml['nlstcall_pp']]
     # Expected form of the basename
-    reg = re.compile(f'{RUNID}a.p([a-z0-9])%C')
-    m = reg.match(basename)
-    if not m:
-        raise Exception("Unexpected string in filename_base in ATMOSCNTL", n['filename_base'])
-    stream = m.group(1)
-    stream_step[stream] = n['reinit_step']
-    if n['reinit_unit']==2:
-        stream_unit[stream] = rrule.DAILY
-    elif n['reinit_unit']==4:
-        stream_unit[stream] = rrule.MONTHLY
+    reg = re.compile(f'{runid}a.p([a-z0-9])%C')
+    for n in iterator:
+        basename = Path(n['filename_base']).name
+        m = reg.match(basename)
+        if not m:
+            raise Exception("Unexpected string in filename_base in ATMOSCNTL", n['filename_base'])
+        stream = m.group(1)
+        stream_step[stream] = n['reinit_step']
+        try:
+            stream_unit[stream] = REINIT_UNITS[n['reinit_unit']]
+        except KeyError:
+            raise Exception('Stream reinit_unit not supported', n)
+
+    # Climate mean has assumed monthly reinit for CM2
+    mean_basename = ""
+    try:
+        mean_basename = nml['nlstcgen']['mean_1_filename_base']
+    except KeyError:
+        pass
+    if mean_basename:
+        mean_basename = Path(mean_basename).name
+        if mean_basename != f'{runid}a.p%C':
+            raise Exception("Unexpected name for climate mean", mean_basename)
+        stream_step['m'] = 1
+        stream_unit['m'] = rrule.MONTHLY
+    return stream_unit, stream_step
+
+def get_jobs(streams, stream_unit, stream_step, prefix, input_dir, start_date, end_date):
+    """Conversions for each requested stream between start_date and end_date"""
+    output_dir = input_dir / 'netCDF'
+    jobs = []
+    for stream in streams:
+
+        if not stream.isalnum():
+            # Skip spaces, commas etc
+            continue
+        if stream not in stream_unit:
+            print(f"Warning: requested stream {stream} not found in model namelist")
+            continue
+        # Loop over time
+        print(f'stream: {stream}')
+        for date in rrule.rrule(stream_unit[stream], interval=stream_step[stream],
+                                dtstart=start_date, until=end_date):
+
+            # Behaviour of the UM %C format
+            if stream_unit[stream] == rrule.MONTHLY:
+                datestr = date.strftime('%04Y%b').lower()
+            elif stream_unit[stream] == rrule.HOURLY:
+                datestr = date.strftime('%04Y%m%d_%H')
+            else:
+                datestr = date.strftime('%04Y%m%d')
+
+            input_file = prefix + stream + datestr
+            jobs.append(Job(stream, date, input_dir / input_file,
+                            output_dir / (input_file + '.nc')))
+    return jobs
+
+def stream_plan(namelist, runid, streams, start_date, end_date, input_dir,
+                cache_dir=None):
+    """
+    The conversions (see Job) of the requested streams between start_date
+    and end_date, for the output streams in the UM namelist file (ATMOSCNTL).
+    Outputs go to input_dir/netCDF.
+
+    With cache_dir the reinitialisation unit and step of each stream are
+    saved to PLAN_NAME there, and reused while the namelist is unchanged,
+    saving parsing it again in later cycles. The dates are worked out on
+    every call.
+    """
+    text = Path(namelist).read_bytes()
+    digest = hashlib.sha1(text)
+    digest.update(repr((PLAN_VERSION, runid)).encode())
+    key = digest.hexdigest()
+    plan = None
+    if cache_dir:
+        cache = Path(cache_dir) / PLAN_NAME
+        try:
+            with open(cache) as f:
+                plan = json.load(f)
+            if plan['key'] != key:
+                plan = None
+        except (FileNotFoundError, ValueError, KeyError):
+            plan = None
+
+    if plan:
+        stream_unit, stream_step = plan['unit'], plan['step']
     else:
-        raise Exception('Stream reinit_unit not supported', n)
-
-# Climate mean has assumed monthly reinit for CM2
-mean_basename = ""
-try:
-    mean_basename = nml['nlstcgen']['mean_1_filename_base']
-except KeyError:
-    pass
-if mean_basename:
-    mean_basename = Path(mean_basename).name
-    if mean_basename != f'{RUNID}a.p%C':
-        raise Exception("Unexpected name for climate mean", mean_basename)
-    stream_step['m'] = 1
-    stream_unit['m'] = rrule.MONTHLY
-
-for stream in STREAMS:
-
-    if not stream.isalnum():
-        # Skip spaces, commas etc
-        continue
-    # Loop over time
-    print(f'stream: {stream}')
-    if stream not in stream_unit:
-        print(f"Warning: requested stream {stream} not found in model namelist")
-        continue
-    for date in rrule.rrule(stream_unit[stream], interval=stream_step[stream],
-                            dtstart=start_date, until=end_date):
-
-        # Behaviour of the UM %C format
-        if stream_unit[stream] == rrule.MONTHLY:
-            datestr = date.strftime('%04Y%b').lower()
-        else:
-            datestr = date.strftime('%04Y%m%d')
+        stream_unit, stream_step = get_streams(f90nml.reads(text.decode()), runid)
+        if cache_dir:
+            tmp = cache.with_name(PLAN_NAME + '.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({'key': key, 'unit': stream_unit, 'step': stream_step},
+                          f, indent=1)
+            os.replace(tmp, cache)
+    return get_jobs(streams, stream_unit, stream_step, runid+'a.p', Path(input_dir),
+                    start_date, end_date)
+
+def cycle_date(point):
+    """Date and hour of an ISO8601 cycle point, ignoring any time zone"""
+    date = datetime.datetime.strptime(point[:8], '%Y%m%d')
+    if point[8:9] == 'T':
+        date += datetime.timedelta(hours=int(point[9:11]))
+    return date
+
+def input_size(job):
+    try:
+        return job.input.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+def checksum(filename, copy_to=None):
+    """sha1 of a file, read in blocks, optionally copying it to copy_to"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f, \
+         (open(copy_to, 'wb') if copy_to else open(os.devnull, 'wb')) as out:
+        while block := f.read(CHECKSUM_BLOCK):
+            digest.update(block)
+            out.write(block)
+    if copy_to:
+        shutil.copymode(filename, copy_to)
+    return digest.hexdigest()
+
+class Manifest:
+    """
+    Status of the conversions into an output directory, saved to
+    MANIFEST_NAME there after every change. Entries are keyed by output file
+    name.
+    """
+    def __init__(self, directory):
+        self.filename = Path(directory) / MANIFEST_NAME
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def save(self):
+        tmp = self.filename.with_name(self.filename.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.filename)
 
-        input_file = prefix + stream + datestr
-        output_file = input_file + '.nc'
-        if arch:
-            input_dir = Path(ARCHIVEDIR) / 'history' / 'atm'
+    def update(self, job, **values):
+        with self.lock:
+            self.entries.setdefault(job.output.name, {}).update(values)
+            self.save()
+
+    def completed(self, job, trust=False):
+        """
+        Whether the output of job is complete and was converted from the
+        current input. With trust the input is not checked.
+        """
+        entry = self.entries.get(job.output.name)
+        if not entry or entry['status'] != 'done':
+            return False
+        try:
+            if job.output.stat().st_size != entry['output_size']:
+                return False
+            stat = job.input.stat()
+        except FileNotFoundError:
+            # Removed by REMOVE_FF after the conversion
+            return job.output.exists()
+        if trust:
+            return True
+        if stat.st_size != entry['input_size']:
+            return False
+        if stat.st_mtime == entry['input_mtime']:
+            return True
+        return (entry.get('checksum') is not None and
+                checksum(job.input) == entry['checksum'])
+
+    def start(self, job):
+        stat = job.input.stat()
+        self.update(job, status='started', input=str(job.input),
+                    input_size=stat.st_size, input_mtime=stat.st_mtime)
+
+    def done(self, job, digest=None):
+        self.update(job, status='done', checksum=digest,
+                    output_size=job.output.stat().st_size)
+
+    def failed(self, job):
+        self.update(job, status='failed')
+
+def pending_jobs(jobs, manifest, trust=False, remove_ff=False):
+    """
+    The jobs without a completed output. Any output left by an interrupted
+    or failed conversion is removed, as are the inputs of completed jobs
+    with remove_ff.
+    """
+    pending = []
+    for job in jobs:
+        if manifest.completed(job, trust):
+            print(job.output, "already converted")
+            if remove_ff:
+                job.input.unlink(missing_ok=True)
+            continue
+        entry = manifest.entries.get(job.output.name)
+        if entry and job.output.exists():
+            if entry['status'] == 'done':
+                print(job.output, "input or output changed, converting again")
+            else:
+                print(job.output, f"incomplete ({entry['status']}), converting again")
+            job.output.unlink()
+        pending.append(job)
+    return pending
+
+def set_memory_limit(limit):
+    """Limit the address space of this process to limit bytes"""
+    if limit:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def convert(job, remove_ff=False):
+    """Convert a single file. Returns False if the input doesn't exist"""
+    if not job.input.exists():
+        print(job.input, "not all files are available, processing for this month not complete")
+        return False
+    um2netcdf4.process(job.input, job.output, ARGS)
+    if remove_ff:
+        job.input.unlink()
+    return True
+
+def convert_staged(tmp_input, tmp_output):
+    """Convert a file copied to JOBFS, removing the copy afterwards"""
+    try:
+        um2netcdf4.process(tmp_input, tmp_output, ARGS)
+    finally:
+        tmp_input.unlink()
+
+class StagingSpace:
+    """Bytes of JOBFS in use, blocking while more than limit would be used"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            # A single file larger than the limit is let through on its own
+            self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+def run_jobs(jobs, manifest, workers=1, memory_limit=None, remove_ff=False):
+    """
+    Convert all the jobs, largest input first, recording them in manifest.
+    Returns a dictionary of the jobs that failed and their error messages.
+    """
+    jobs = sorted(jobs, key=input_size, reverse=True)
+    failed = {}
+
+    def finished(job, result):
+        try:
+            converted = result()
+        except Exception:
+            failed[job] = traceback.format_exc()
+            print(f"Error converting {job.input}\n{failed[job]}")
+            manifest.failed(job)
         else:
-            input_dir = Path(DATAM)
-        output_dir = input_dir / 'netCDF'
-        output_dir.mkdir(exist_ok = True)
-        input = input_dir / input_file
-        output = output_dir / output_file
-        # Named tuple to hold the argument list
-        Args = collections.namedtuple('Args', 'nckind compression simple nomask hcrit verbose include_list exclude_list nohist use64bit')
-        args = Args(3, 4, True, False, 0.5, False, None, None, False, False)
-        print(input)
-        if USE_JOBFS:
-            # Copy the files to and from JOBFS
-            tmp_input = Path(PBS_JOBFS) / input_file
-            tmp_output = Path(PBS_JOBFS) / output_file
-            print("jobfs files", tmp_input, tmp_output)
-            shutil.copy(input, tmp_input)
-            um2netcdf4.process(tmp_input, tmp_output, args)
-            tmp_input.unlink()
-            shutil.move(tmp_output, output)
+            if converted:
+                manifest.done(job)
+                print(job.input, 'done')
+
+    # The limit only applies to worker processes, so with one a worker is
+    # still used to keep it off this process
+    if workers == 1 and not memory_limit:
+        for job in jobs:
+            print(job.input)
+            if job.input.exists():
+                manifest.start(job)
+            finished(job, functools.partial(convert, job, remove_ff))
+        return failed
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=set_memory_limit,
+            initargs=(memory_limit,)) as executor:
+        futures = {}
+        for job in jobs:
+            if job.input.exists():
+                manifest.start(job)
+            futures[executor.submit(convert, job, remove_ff)] = job
+        for future in concurrent.futures.as_completed(futures):
+            finished(futures[future], future.result)
+    return failed
+
+def run_jobs_jobfs(jobs, manifest, jobfs, workers=1, memory_limit=None,
+                   remove_ff=False, prefetch=2, staging_limit=None):
+    """
+    As run_jobs, but converting copies of the inputs in the directory jobfs.
+    Up to prefetch inputs are copied in ahead of the conversions and the
+    outputs are moved back by background threads, so that the copies overlap
+    with the conversions. Each file reserves twice its input size of JOBFS
+    (input and output) from staging_limit bytes until its output is moved
+    back.
+    """
+    jobs = sorted(jobs, key=input_size, reverse=True)
+    jobfs = Path(jobfs)
+    if staging_limit is None:
+        staging_limit = shutil.disk_usage(jobfs).free * 0.9
+    space = StagingSpace(staging_limit)
+    # Inputs copied but not yet converted
+    ahead = threading.BoundedSemaphore(prefetch + workers)
+    failed = {}
+    lock = threading.Lock()
+
+    def fail(job):
+        with lock:
+            failed[job] = traceback.format_exc()
+        print(f"Error converting {job.input}\n{failed[job]}")
+        manifest.failed(job)
+
+    def stage_in(job):
+        if not job.input.exists():
+            print(job.input, "not all files are available, processing for this month not complete")
+            return None
+        size = 2 * input_size(job)
+        ahead.acquire()
+        space.acquire(size)
+        tmp_input = jobfs / job.input.name
+        try:
+            manifest.start(job)
+            digest = checksum(job.input, tmp_input)
+        except Exception:
+            space.release(size)
+            ahead.release()
+            raise
+        print("jobfs files", tmp_input, jobfs / job.output.name)
+        return size, digest
+
+    def stage_out(job, size, digest):
+        try:
+            shutil.move(jobfs / job.output.name, job.output)
+            manifest.done(job, digest)
+            if remove_ff:
+                job.input.unlink()
+            print(job.input, 'done')
+        except Exception:
+            fail(job)
+        finally:
+            space.release(size)
+
+    def converted(job, size, digest, future):
+        # Called once the conversion has finished, in whichever thread
+        # completed it
+        ahead.release()
+        try:
+            future.result()
+        except Exception:
+            (jobfs / job.output.name).unlink(missing_ok=True)
+            space.release(size)
+            fail(job)
         else:
-            if os.path.exists(input):
-                um2netcdf4.process(input, output, args)
+            movers.submit(stage_out, job, size, digest)
+
+    if workers == 1 and not memory_limit:
+        converter = None
+    else:
+        converter = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=set_memory_limit,
+            initargs=(memory_limit,))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(prefetch, 1)) as copiers, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=max(prefetch, 1)) as movers:
+        staged = {copiers.submit(stage_in, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(staged):
+            job = staged[future]
+            try:
+                staged_in = future.result()
+            except Exception:
+                fail(job)
+                continue
+            if staged_in is None:
+                continue
+            size, digest = staged_in
+            args = (jobfs / job.input.name, jobfs / job.output.name)
+            if converter:
+                converter.submit(convert_staged, *args).add_done_callback(
+                    functools.partial(converted, job, size, digest))
             else:
-                print("not all files are available, processing for this month not complete")
-        if REMOVE_FF:
-            input.unlink()
+                conversion = concurrent.futures.Future()
+                try:
+                    convert_staged(*args)
+                    conversion.set_result(None)
+                except Exception as e:
+                    conversion.set_exception(e)
+                converted(job, size, digest, conversion)
+        if converter:
+            # Wait for the conversions, which queue the last moves
+            converter.shutdown()
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the UM output of this cycle to netCDF")
+    parser.add_argument('--resume', action='store_true',
+                        help="Trust the outputs the manifest records as complete, without checking their inputs")
+    cmdargs = parser.parse_args()
+
+    CYLC_TASK_CYCLE_POINT = os.environ['CYLC_TASK_CYCLE_POINT']
+    NEXT_CYCLE = os.environ['NEXT_CYCLE']
+    RUNID = os.environ['RUNID']
+    STREAMS = os.environ['NETCDF_STREAMS']
+    try:
+        ARCHIVEDIR = os.environ['ARCHIVEDIR']
+        arch = True
+    except:
+        DATAM = os.environ['DATAM']
+        arch = False
+    print("archive (history/atm): ", arch)
+    REMOVE_FF = os.environ['REMOVE_FF'].lower() == 'true'
+    print("REMOVE_FF", REMOVE_FF)
+    try:
+        USE_JOBFS = os.environ['USE_JOBFS'].lower() == 'true'
+    except KeyError:
+        USE_JOBFS = False
+    if USE_JOBFS:
+        PBS_JOBFS = os.environ['PBS_JOBFS']
+        PREFETCH = int(os.environ.get('JOBFS_PREFETCH', 2))
+        try:
+            STAGING_LIMIT = float(os.environ['JOBFS_STAGING_GB']) * 1024**3
+        except KeyError:
+            STAGING_LIMIT = None
+    WORKERS = int(os.environ.get('NETCDF_WORKERS', 1))
+    try:
+        MEMORY_LIMIT = int(float(os.environ['NETCDF_WORKER_MEMORY']) * 1024**3)
+    except KeyError:
+        MEMORY_LIMIT = None
+    print("workers", WORKERS, "memory limit", MEMORY_LIMIT)
+
+    start_date = cycle_date(CYLC_TASK_CYCLE_POINT)
+    end_date = cycle_date(NEXT_CYCLE) - datetime.timedelta(seconds=1)
+    ATM_RUNDIR=os.environ['ATM_RUNDIR']
+
+    if arch:
+        input_dir = Path(ARCHIVEDIR) / 'history' / 'atm'
+    else:
+        input_dir = Path(DATAM)
+    output_dir = input_dir / 'netCDF'
+    output_dir.mkdir(exist_ok = True)
+
+    # Get the reinitialisation unit and frequency of the streams from the UM
+    # namelist
+    jobs = stream_plan(Path(ATM_RUNDIR)/'ATMOSCNTL', RUNID, STREAMS, start_date,
+                       end_date, input_dir, output_dir)
+    manifest = Manifest(output_dir)
+    jobs = pending_jobs(jobs, manifest, cmdargs.resume, REMOVE_FF)
+    if USE_JOBFS:
+        failed = run_jobs_jobfs(jobs, manifest, PBS_JOBFS, WORKERS, MEMORY_LIMIT,
+                                REMOVE_FF, PREFETCH, STAGING_LIMIT)
+    else:
+        failed = run_jobs(jobs, manifest, WORKERS, MEMORY_LIMIT, REMOVE_FF)
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} conversions failed:")
+        for job in failed:
+            print("   ", job.input)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Vertical level sets of the UM, used by setup_ozone_input.py and
+redistribute_ozone.py.
+
+Each level set is stored as levels/<name>.npz next to this file, holding the
+rho level height bounds 'level_height_bounds' [nlev,2] (m), the hybrid height
+terrain following coefficient 'sigma' [nlev] and its bounds 'sigma_bounds'
+[nlev,2], plus the file format 'version'.
+
+"""
+import collections
+import functools
+import glob
+import os
+
+import numpy as np
+
+LEVELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'levels')
+LEVELS_VERSION = 1
+DEFAULT_LEVELS = 'L85'
+
+LevelSet = collections.namedtuple(
+    'LevelSet', ['name', 'level_height_bounds', 'sigma', 'sigma_bounds'])
+
+
+def available_level_sets():
+    """Names of the level sets in LEVELS_DIR"""
+    return sorted(os.path.splitext(os.path.basename(f))[0]
+                  for f in glob.glob(os.path.join(LEVELS_DIR, '*.npz')))
+
+
+@functools.lru_cache(maxsize=None)
+def level_set(name=DEFAULT_LEVELS):
+    """
+    Load the level set 'name', either the name of a file in LEVELS_DIR (e.g.
+    'L85') or the path of an .npz file with the same contents.  Files are read
+    once per process and the arrays returned are read-only.
+
+    """
+    if os.path.sep in name or name.endswith('.npz'):
+        filename = name
+    else:
+        filename = os.path.join(LEVELS_DIR, name + '.npz')
+    if not os.path.exists(filename):
+        raise ValueError(
+            "Unknown vertical level set {}, available: {}".format(
+                name, ', '.join(available_level_sets())))
+
+    with np.load(filename) as data:
+        version = int(data['version'])
+        if version != LEVELS_VERSION:
+            raise ValueError(
+                "{} has format version {}, expected {}".format(
+                    filename, version, LEVELS_VERSION))
+        levels = LevelSet(name, data['level_height_bounds'], data['sigma'],
+                          data['sigma_bounds'])
+
+    nlev = len(levels.sigma)
+    if (levels.level_height_bounds.shape != (nlev, 2) or
+            levels.sigma_bounds.shape != (nlev, 2)):
+        raise ValueError(
+            "Inconsistent number of levels in {}".format(filename))
+    for array in levels[1:]:
+        array.flags.writeable = False
+    return levels
+
+
+def check_levels(levels, nlev, what):
+    """Raise ValueError unless 'what' has as many levels as 'levels'"""
+    if nlev != len(levels.sigma):
+        raise ValueError(
+            "{} has {} levels but level set {} has {}".format(
+                what, nlev, levels.name, len(levels.sigma)))
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts in src are run directly rather than installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
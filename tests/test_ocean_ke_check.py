@@ -0,0 +1,76 @@
+"""
+ocean_ke_check.py on ocean_scalar files like those MOM writes.
+
+"""
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip('netCDF4')
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src',
+                      'ocean_ke_check.py')
+
+
+def write_scalar(filename, ke, first_time=0.):
+    """ke_tot(time, scalar_axis) with the values ke, as MOM writes it"""
+    with netCDF4.Dataset(filename, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('scalar_axis', 1)
+        ds.createVariable('time', 'f8', ('time',))[:] = first_time + np.arange(len(ke))
+        ds.createVariable('scalar_axis', 'f8', ('scalar_axis',))[:] = [0.]
+        var = ds.createVariable('ke_tot', 'f4', ('time', 'scalar_axis'),
+                                fill_value=-1.e34)
+        var[:] = np.ma.masked_invalid(np.asarray(ke, dtype=float))[:, np.newaxis]
+
+
+def run(*args):
+    return subprocess.run([sys.executable, SCRIPT] + [str(a) for a in args],
+                          capture_output=True, text=True)
+
+
+def test_scalar_axis(tmp_path):
+    filename = tmp_path / 'ocean_scalar.nc'
+    write_scalar(filename, [100., 200., 150.])
+    result = run(filename)
+    assert result.returncode == 0, result.stderr
+    assert 'Max ocean KE 200' in result.stdout
+
+    write_scalar(filename, [100., 2000., 150.])
+    result = run(filename)
+    assert result.returncode == 1
+    assert 'FAIL ke_tot max 1500: 2000 at record 1' in result.stdout
+
+
+def test_scalar_axis_rules_and_state(tmp_path):
+    filename = tmp_path / 'ocean_scalar.nc'
+    rules = tmp_path / 'rules.json'
+    state = tmp_path / 'state.json'
+    rules.write_text(json.dumps([
+        {'variable': 'ke_tot', 'type': 'abs_delta', 'threshold': 500},
+        {'variable': 'ke_tot', 'type': 'slope', 'window': 3, 'threshold': 300}]))
+    write_scalar(filename, [100., 200., 300.])
+    result = run('--rules', rules, '--state', state, filename)
+    assert result.returncode == 0, result.stderr
+
+    # Records added to the same file are checked with the tail kept
+    with netCDF4.Dataset(filename, 'a') as ds:
+        ds['time'][3:5] = [3., 4.]
+        ds['ke_tot'][3:5] = [[400.], [1200.]]
+    result = run('--rules', rules, '--state', state, filename)
+    assert result.returncode == 1
+    assert 'FAIL ke_tot abs_delta 500: 800 at record 4' in result.stdout
+    assert 'FAIL ke_tot slope(3) 300: 450 at record 4' in result.stdout
+
+
+def test_all_missing(tmp_path):
+    filename = tmp_path / 'ocean_scalar.nc'
+    write_scalar(filename, [np.nan, np.nan])
+    result = run(filename)
+    assert result.returncode == 0, result.stderr
+    assert 'Max ocean KE: no valid data' in result.stdout
+    assert '---- ke_tot max 1500: no valid data' in result.stdout
@@ -0,0 +1,141 @@
+"""
+The vectorised kernels of redistribute_ozone.py must give exactly the results
+of the loops they replaced.
+
+"""
+import numpy as np
+import pytest
+
+from ozone_kernels import (TROPOPAUSE_OZONE, centred_difference,
+                           redistribute_columns)
+
+NLEV, NLAT, NLON = 85, 145, 192
+NMONTH = 12
+
+
+def loop_spacing(points):
+    """dlon and dlat as the loops before user-001 computed them"""
+    n = np.size(points)
+    spacing = np.ones(n)
+    for i in np.arange(1, n-1):
+        spacing[i] = (points[i+1] - points[i-1])/2.
+    spacing[0] = points[1] - points[0]
+    spacing[n-1] = points[n-1] - points[n-2]
+    return spacing
+
+
+def loop_dz(hz):
+    """dz as the loops before user-001 computed it, for any number of levels"""
+    nlev, nlat, nlon = hz.shape
+    dz = np.ones([nlev, nlat, nlon])
+    for j in np.arange(nlat):
+        for k in np.arange(nlon):
+            for i in np.arange(1, nlev-1):
+                dz[i, j, k] = (hz[i+1, j, k] - hz[i-1, j, k])/2.
+            dz[0, j, k] = hz[1, j, k] - hz[0, j, k]
+            dz[nlev-1, j, k] = hz[nlev-1, j, k] - hz[nlev-2, j, k]
+    return dz
+
+
+def synthetic_heights(dtype):
+    """Stretched hybrid height levels over random orography"""
+    rng = np.random.default_rng(1)
+    eta = (np.arange(1, NLEV+1) / NLEV)**2
+    sigma = np.where(eta < 0.3, (1. - eta/0.3)**2, 0.)
+    orog = 3000. * rng.random((NLAT, NLON))
+    hz = (85000. * eta[:, np.newaxis, np.newaxis] +
+          sigma[:, np.newaxis, np.newaxis] * orog[np.newaxis])
+    return hz.astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_dz_matches_loop(dtype):
+    hz = synthetic_heights(dtype)
+    dz = centred_difference(hz, axis=0)
+    assert dz.dtype == np.float64
+    np.testing.assert_array_equal(dz, loop_dz(hz))
+
+
+def test_dz_takes_levels_from_heights():
+    hz = synthetic_heights(np.float64)[:38, :10, :12]
+    np.testing.assert_array_equal(centred_difference(hz, axis=0), loop_dz(hz))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_spacing_matches_loop(dtype):
+    latitude = ((np.arange(NLAT) * 180. / (NLAT - 1)) - 90.).astype(dtype)
+    longitude = ((np.arange(NLON) + 0.5) * 360. / NLON).astype(dtype)
+    for points in (latitude, longitude):
+        np.testing.assert_array_equal(centred_difference(points),
+                                      loop_spacing(points))
+
+
+def test_too_few_points():
+    with pytest.raises(ValueError):
+        centred_difference(np.zeros((1, 3)), axis=0)
+
+
+def loop_redistribute(oz2d_dat, hz, th_dat):
+    """The per-column redistribution before user-002"""
+    oz_redist = oz2d_dat.copy()
+    nmonth, _, nlat = oz2d_dat.shape
+    for l in np.arange(nmonth):
+        for j in np.arange(nlat):
+            counter_dyntrop = np.where(hz[:, j] > (th_dat[l, j] - 1000.))[0]
+            counter_dyntrop = counter_dyntrop[0]
+            oz_redist[l, counter_dyntrop, j] = 1.32e-7  # 80ppbv
+            counter_highoz = np.where(hz[:, j] > (th_dat[l, j] + 2000.))[0]
+            counter_highoz = 1+counter_highoz[0]
+            ozint = [np.log(oz_redist[l, counter_dyntrop, j]),
+                     np.log(oz2d_dat[l, counter_highoz, j])]
+            htint = [hz[counter_dyntrop, j], hz[counter_highoz, j]]
+            htsint = hz[counter_dyntrop:counter_highoz, j]
+            oz_redist[l, counter_dyntrop:counter_highoz, j] = np.exp(
+                np.interp(htsint, htint, ozint))
+            if (oz2d_dat[l, counter_dyntrop, j] < 1.32e-7):
+                counter_lowoz = np.where(hz[:, j] > (th_dat[l, j] - 3000.))[0]
+                counter_lowoz = counter_lowoz[0]
+                ozint = [np.log(oz2d_dat[l, counter_lowoz, j]),
+                         np.log(oz_redist[l, counter_dyntrop, j])]
+                htint = [hz[counter_lowoz, j], hz[counter_dyntrop, j]]
+                htsint = hz[counter_lowoz:counter_dyntrop, j]
+                oz_redist[l, counter_lowoz:counter_dyntrop, j] = np.exp(
+                    np.interp(htsint, htint, ozint))
+            if (oz2d_dat[l, counter_dyntrop, j] > 1.32e-7):
+                counter_oztrop = np.where(oz2d_dat[l, :, j] < 1.32e-7)[0]
+                counter_oztrop = counter_oztrop[np.size(counter_oztrop)-1]
+                oz_redist[l, counter_oztrop+1:counter_dyntrop, j] = 1.32e-7
+    return oz_redist
+
+
+def synthetic_columns(dtype):
+    """
+    Zonal mean ozone [nmonth,nlev,nlat] with a stratospheric peak whose size
+    varies with latitude, so the ozone at the ozone tropopause is below
+    80ppbv in some columns and above in others, the level heights [nlev,nlat]
+    and the dynamical tropopause [nmonth,nlat]
+    """
+    rng = np.random.default_rng(2)
+    hz = synthetic_heights(np.float64)[:, :, 0]
+    lat = np.radians(np.linspace(-90., 90., NLAT))
+    month = np.arange(NMONTH)[:, np.newaxis]
+    th = (16500. - 7000. * np.sin(lat)**2 +
+          800. * np.cos(2. * np.pi * month / 12.) * np.sin(lat))
+    peak = 10.**rng.uniform(-6., -4.5, (NMONTH, NLAT))
+    profile = np.exp(-((hz - 30000.) / 9000.)**2)
+    oz = 4.e-8 + profile[np.newaxis] * peak[:, np.newaxis, :]
+    return oz.astype(dtype), hz, th
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_redistribution_matches_loop(dtype):
+    oz, hz, th = synthetic_columns(dtype)
+    # Both branches at the ozone tropopause are exercised
+    dyntrop = (hz[np.newaxis] > (th - 1000.)[:, np.newaxis, :]).argmax(axis=1)
+    oz_dyntrop = np.take_along_axis(oz, dyntrop[:, np.newaxis, :], axis=1)
+    assert (oz_dyntrop < TROPOPAUSE_OZONE).any()
+    assert (oz_dyntrop > TROPOPAUSE_OZONE).any()
+
+    redist = redistribute_columns(oz, hz, th)
+    assert redist.dtype == oz.dtype
+    np.testing.assert_array_equal(redist, loop_redistribute(oz, hz, th))
@@ -0,0 +1,87 @@
+"""
+The netCDF4 path of setup_ozone_input.py (--fast) must write the same file as
+the iris path.
+
+"""
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip('netCDF4')
+pytest.importorskip('iris')
+
+import setup_ozone_input  # noqa: E402
+import vertical_levels  # noqa: E402
+
+NLAT, NLON = 6, 8
+FILL_VALUE = 1.e20
+
+
+def write_um_month(filename):
+    """A month of um2netcdf4.py output with the fields read, some missing"""
+    nlev = len(vertical_levels.level_set().sigma)
+    rng = np.random.default_rng(0)
+    with netCDF4.Dataset(filename, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', 1)
+        ds.createDimension('z', nlev)
+        ds.createDimension('lat', NLAT)
+        ds.createDimension('lon', NLON)
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 1970-01-01 00:00'
+        time.standard_name = 'time'
+        time.calendar = 'proleptic_gregorian'
+        time[:] = [10972.5]
+        z = ds.createVariable('z', 'f8', ('z',))
+        z.units = 'm'
+        z.standard_name = 'atmosphere_hybrid_height_coordinate'
+        z.positive = 'up'
+        z.comments = 'height above sea level at the top of the model'
+        z[:] = np.linspace(10., 80000., nlev)
+        lat = ds.createVariable('lat', 'f8', ('lat',))
+        lat.units = 'degrees_north'
+        lat.standard_name = 'latitude'
+        lat[:] = (np.arange(NLAT) + 0.5) * 180. / NLAT - 90.
+        lon = ds.createVariable('lon', 'f8', ('lon',))
+        lon.units = 'degrees_east'
+        lon.standard_name = 'longitude'
+        lon[:] = (np.arange(NLON) + 0.5) * 360. / NLON
+        for name, dims, units in (('fld_s00i033', ('time', 'lat', 'lon'), 'm'),
+                                  ('fld_s00i253', ('time', 'z', 'lat', 'lon'), 'kg m-1'),
+                                  ('fld_s30i453', ('time', 'lat', 'lon'), 'm')):
+            var = ds.createVariable(name, 'f4', dims, fill_value=FILL_VALUE)
+            var.long_name = name
+            var.units = units
+            data = rng.random(var.shape).astype(np.float32)
+            data.flat[::7] = FILL_VALUE
+            var.set_auto_maskandscale(False)
+            var[:] = data
+
+
+def raw_data(filename):
+    with netCDF4.Dataset(filename) as ds:
+        ds.set_auto_maskandscale(False)
+        return {name: var[...] for name, var in ds.variables.items()}
+
+
+def test_fast_path_matches_iris(tmp_path):
+    infile = str(tmp_path / 'um.nc')
+    iris_file = str(tmp_path / 'iris.nc')
+    fast_file = str(tmp_path / 'fast.nc')
+    write_um_month(infile)
+
+    setup_ozone_input.iris_convert(
+        infile, iris_file, setup_ozone_input.iris_vertical(infile))
+    setup_ozone_input.netcdf_convert(
+        infile, fast_file, setup_ozone_input.netcdf_vertical(infile))
+
+    iris_meta = setup_ozone_input.metadata(iris_file)
+    fast_meta = setup_ozone_input.metadata(fast_file)
+    assert sorted(fast_meta) == sorted(iris_meta)
+    for key in iris_meta:
+        # Attribute order matters too
+        assert str(fast_meta[key]) == str(iris_meta[key]), key
+
+    iris_data = raw_data(iris_file)
+    fast_data = raw_data(fast_file)
+    for name in iris_data:
+        np.testing.assert_array_equal(fast_data[name], iris_data[name],
+                                      err_msg=name)